@@ -0,0 +1,386 @@
+#! /usr/bin/env python3
+
+from ryu.app.wsgi import WSGIApplication
+from ryu.controller import ofp_event
+from ryu.lib.packet import packet, ethernet, arp, ether_types
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser, ofproto_parser
+from ryu.topology import event
+from ryu.topology.switches import Switch, Link, Port
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+import tracemalloc
+
+import ryu_multipath
+
+'''
+Offline benchmark of the ProjectController in ryu_multipath.py, without root, Mininet or OVS.
+The controller is driven with fake datapaths that only count the messages they would send. For every
+topology size the benchmark replays the events of a network start and a measurement:
+
+1. switch enter (plus the port description replies of the switches)
+2. link add in both directions
+3. ARP requests of all hosts for an unknown IP, so the controller learns them
+4. ARP requests between random host pairs, each one installs the paths of the pair in both directions
+5. link delete of random links that carry installed paths
+
+and reports the time per phase, the path computations, the messages emitted and the memory of the controller.
+tracemalloc slows the controller down several times, so the memory is measured in a second run of the same
+events and the times are taken from the first run without it.
+
+python3 controller_benchmark.py --topology grid --sizes 4 8 16 32
+python3 controller_benchmark.py --topology fattree --sizes 4 8 16 30 --output fattree.json
+python3 controller_benchmark.py --topology kit --sizes 1 4 12
+'''
+
+# sizes giving 16 to 1000+ switches: grid n -> n*n, fat-tree k -> 5k^2/4, KIT scale s -> 87s+2
+default_sizes = {
+    'grid': [4, 8, 16, 24, 32],
+    'fattree': [4, 8, 16, 24, 30],
+    'kit': [1, 2, 4, 8, 12],
+}
+
+message_types = {
+    ofproto_v1_3.OFPT_FLOW_MOD: 'flow_mod',
+    ofproto_v1_3.OFPT_GROUP_MOD: 'group_mod',
+    ofproto_v1_3.OFPT_PACKET_OUT: 'packet_out',
+    ofproto_v1_3.OFPT_BARRIER_REQUEST: 'barrier',
+    ofproto_v1_3.OFPT_MULTIPART_REQUEST: 'stats_request',
+}
+
+
+class FakeDatapath(object):
+    '''
+    Datapath that counts the messages and bytes it would send and remembers
+    the barriers it has not answered yet
+    '''
+
+    def __init__(self, dpid):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.messages = dict((name, 0) for name in message_types.values())
+        self.messages['other'] = 0
+        self.bytes = 0
+        self.writes = 0
+        self.barriers = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg, close_socket=False):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        return self.send(msg.buf)
+
+    def send(self, buf, close_socket=False):
+        self.writes += 1
+        self.bytes += len(buf)
+        offset = 0
+        while offset < len(buf):
+            version, msg_type, msg_len, xid = ofproto_parser.header(bytes(buf[offset:offset + 8]))
+            self.messages[message_types.get(msg_type, 'other')] += 1
+            if msg_type == ofproto_v1_3.OFPT_BARRIER_REQUEST:
+                self.barriers.append(xid)
+            offset += msg_len
+        return True
+
+
+class SyntheticTopology(object):
+    '''
+    Switches numbered from 1 and links between them with consecutive port
+    numbers per switch. Hosts are attached to the edge switches only
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.ports = {}
+        self.links = []
+        self.edge = []
+
+    def add_switch(self, edge=False):
+        dpid = len(self.ports) + 1
+        self.ports[dpid] = 0
+        if edge:
+            self.edge.append(dpid)
+        return dpid
+
+    def next_port(self, dpid):
+        self.ports[dpid] += 1
+        return self.ports[dpid]
+
+    def add_link(self, s1, s2):
+        self.links.append((s1, self.next_port(s1), s2, self.next_port(s2)))
+
+
+def grid_topology(n):
+    # n x n grid like newTopo.MyTopo (n = 4)
+    topo = SyntheticTopology(f'grid {n}x{n}')
+    switches = [topo.add_switch(edge=True) for i in range(n * n)]
+    for i in range(n):
+        for j in range(n):
+            if j < n - 1:
+                topo.add_link(switches[i * n + j], switches[i * n + j + 1])
+            if i < n - 1:
+                topo.add_link(switches[i * n + j], switches[(i + 1) * n + j])
+    return topo
+
+
+def fattree_topology(k):
+    # k-ary fat-tree: (k/2)^2 core switches, k pods with k/2 aggregation and k/2 edge switches
+    half = k // 2
+    topo = SyntheticTopology(f'fat-tree k={k}')
+    core = [topo.add_switch() for i in range(half * half)]
+    for pod in range(k):
+        aggregation = [topo.add_switch() for i in range(half)]
+        edge = [topo.add_switch(edge=True) for i in range(half)]
+        for a in aggregation:
+            for e in edge:
+                topo.add_link(a, e)
+        for i, a in enumerate(aggregation):
+            for c in core[i * half:(i + 1) * half]:
+                topo.add_link(a, c)
+    return topo
+
+
+def kit_topology(scale):
+    # leaf/spine layout of KIT_Topology/kit_topology_v5.py, with the routers as switches:
+    # every leaf switch hangs at router R1, R1 and R2 are connected and both uplink to the campus spine.
+    # scale multiplies the 16 north and 13 south leafs, the spines are connected with each other
+    topo = SyntheticTopology(f'KIT leaf/spine x{scale}')
+    spine_north = topo.add_switch()
+    spine_south = topo.add_switch()
+    topo.add_link(spine_north, spine_south)
+    for spine, leafs in ((spine_north, 16 * scale), (spine_south, 13 * scale)):
+        for i in range(leafs):
+            leaf = topo.add_switch(edge=True)
+            router1 = topo.add_switch()
+            router2 = topo.add_switch()
+            topo.add_link(leaf, router1)
+            topo.add_link(router1, router2)
+            topo.add_link(router1, spine)
+            topo.add_link(router2, spine)
+    return topo
+
+
+topologies = {
+    'grid': grid_topology,
+    'fattree': fattree_topology,
+    'kit': kit_topology,
+}
+
+
+class PortDesc(object):
+    # stand-in for the ofproto port description ryu.topology.switches.Port is built from
+    def __init__(self, port_no):
+        self.port_no = port_no
+        self.hw_addr = '00:00:00:00:00:00'
+        self.name = b'port%d' % port_no
+        self.config = 0
+        self.state = 0
+
+
+def acknowledge_barriers(app, datapaths):
+    # answer all barriers, including those of ingress switches written after the first replies
+    while True:
+        answered = False
+        for dp in datapaths.values():
+            barriers, dp.barriers = dp.barriers, []
+            for xid in barriers:
+                reply = ofproto_v1_3_parser.OFPBarrierReply(dp)
+                reply.xid = xid
+                app.barrier_reply_handler(ofp_event.EventOFPBarrierReply(reply))
+                answered = True
+        if not answered:
+            return
+
+
+def arp_packet_in(app, dp, in_port, src_mac, src_ip, dst_ip):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP,
+                                       dst='ff:ff:ff:ff:ff:ff', src=src_mac))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=src_mac, src_ip=src_ip,
+                             dst_mac='00:00:00:00:00:00', dst_ip=dst_ip))
+    pkt.serialize()
+    msg = ofproto_v1_3_parser.OFPPacketIn(
+        dp, buffer_id=ofproto_v1_3.OFP_NO_BUFFER,
+        match=ofproto_v1_3_parser.OFPMatch(in_port=in_port), data=pkt.data)
+    app._packet_in_handler(ofp_event.EventOFPPacketIn(msg))
+
+
+def count_messages(datapaths):
+    total = {}
+    for dp in datapaths.values():
+        for name, count in dp.messages.items():
+            total[name] = total.get(name, 0) + count
+    total['bytes'] = sum(dp.bytes for dp in datapaths.values())
+    total['writes'] = sum(dp.writes for dp in datapaths.values())
+    return total
+
+
+def path_computations(app):
+    histogram = app.metrics.histograms.get('controller_path_compute_seconds')
+    if histogram is None:
+        return 0, 0.0
+    return sum(histogram[0]), histogram[1]
+
+
+def run(topo, args, seed, trace_memory=False):
+    rng = random.Random(seed)
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+    # every run starts cold, without the state of a previous controller
+    ryu_multipath.SNAPSHOT_FILE = None
+    # the replay is synchronous, so paths are computed inline
+    ryu_multipath.PATH_WORKERS = 0
+    app = ryu_multipath.ProjectController(wsgi=WSGIApplication())
+    datapaths = dict((dpid, FakeDatapath(dpid)) for dpid in topo.ports)
+
+    # hosts get the ports after the switch links
+    hosts = []
+    for i in range(args.hosts):
+        dpid = rng.choice(topo.edge)
+        hosts.append((dpid, topo.next_port(dpid), '02:00:00:%02x:%02x:%02x' % (
+            i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), '10.%d.%d.%d' % (
+            i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)))
+
+    def phase(name, events):
+        messages = count_messages(datapaths)
+        computations, compute_time = path_computations(app)
+        start = time.perf_counter()
+        for callback in events:
+            callback()
+        acknowledge_barriers(app, datapaths)
+        seconds = time.perf_counter() - start
+        after = count_messages(datapaths)
+        computations_after, compute_time_after = path_computations(app)
+        results.append({
+            'phase': name,
+            'events': len(events),
+            'seconds': seconds,
+            'path_computations': computations_after - computations,
+            'path_compute_seconds': compute_time_after - compute_time,
+            'messages': dict((key, after[key] - messages[key]) for key in after),
+        })
+
+    def switch_enter(dpid):
+        dp = datapaths[dpid]
+        app.switch_enter_handler(event.EventSwitchEnter(Switch(dp)))
+        reply = ofproto_v1_3_parser.OFPPortDescStatsReply(dp)
+        reply.body = [ofproto_v1_3_parser.OFPPort(
+            port_no=port, hw_addr='00:00:00:00:00:00', name=b'port%d' % port, config=0,
+            state=0, curr=0, advertised=0, supported=0, peer=0, curr_speed=10000000,
+            max_speed=0) for port in range(1, topo.ports[dpid] + 1)]
+        app.port_desc_stats_reply_handler(ofp_event.EventOFPPortDescStatsReply(reply))
+
+    def link_add(s1, p1, s2, p2):
+        link = Link(Port(s1, ofproto_v1_3, PortDesc(p1)), Port(s2, ofproto_v1_3, PortDesc(p2)))
+        app.link_add_handler(event.EventLinkAdd(link))
+
+    def link_delete(s1, p1, s2, p2):
+        link = Link(Port(s1, ofproto_v1_3, PortDesc(p1)), Port(s2, ofproto_v1_3, PortDesc(p2)))
+        app.link_delete_handler(event.EventLinkDelete(link))
+
+    def announce(host):
+        dpid, port, host_mac, host_ip = host
+        arp_packet_in(app, datapaths[dpid], port, host_mac, host_ip, '192.0.2.1')
+
+    def request(src, dst):
+        arp_packet_in(app, datapaths[src[0]], src[1], src[2], src[3], dst[3])
+
+    def failure():
+        # a random link that carries installed paths, or any link if none does
+        alive = [link for link in topo.links if link[2] in app.adjacency[link[0]]]
+        used = [link for link in alive
+                if app.link_installs.get((link[0], link[1])) or app.link_installs.get((link[2], link[3]))]
+        s1, p1, s2, p2 = rng.choice(used or alive)
+        link_delete(s1, p1, s2, p2)
+        link_delete(s2, p2, s1, p1)
+
+    pairs = []
+    while len(pairs) < args.pairs and len(hosts) > 1:
+        src, dst = rng.sample(hosts, 2)
+        pairs.append((src, dst))
+
+    output = open(os.devnull, 'w') if not args.verbose else None
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        phase('switch_enter', [lambda dpid=dpid: switch_enter(dpid) for dpid in sorted(datapaths)])
+        phase('link_add', [lambda link=link: (link_add(*link), link_add(link[2], link[3], link[0], link[1]))
+                           for link in topo.links])
+        phase('arp_learn', [lambda host=host: announce(host) for host in hosts])
+        phase('arp_install', [lambda pair=pair: request(*pair) for pair in pairs])
+        phase('link_delete', [failure for i in range(args.failures)])
+    if output:
+        output.close()
+
+    memory = None
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = {'current': current, 'peak': peak}
+    flows = sum(len(flows) for flows in app.flows.values())
+    return {
+        'topology': topo.name,
+        'switches': len(topo.ports),
+        'links': len(topo.links),
+        'hosts': len(hosts),
+        'pairs': len(pairs),
+        'flows': flows,
+        'groups': len(app.group_refs),
+        'memory': memory,
+        'phases': results,
+    }
+
+
+def print_result(result):
+    memory = ''
+    if result['memory']:
+        memory = f", memory {result['memory']['current'] / 2**20:.1f} MB (peak {result['memory']['peak'] / 2**20:.1f} MB)"
+    print(f"[+] {result['topology']}: {result['switches']} switches, {result['links']} links, "
+          f"{result['hosts']} hosts, {result['pairs']} pairs -> {result['flows']} flows, "
+          f"{result['groups']} groups{memory}")
+    print(f"    {'phase':<13}{'events':>8}{'time ms':>11}{'paths':>8}{'path ms':>10}"
+          f"{'flow_mod':>10}{'group_mod':>10}{'pkt_out':>9}{'barrier':>9}{'kbytes':>9}")
+    for phase in result['phases']:
+        messages = phase['messages']
+        print(f"    {phase['phase']:<13}{phase['events']:>8}{phase['seconds'] * 1000:>11.1f}"
+              f"{phase['path_computations']:>8}{phase['path_compute_seconds'] * 1000:>10.1f}"
+              f"{messages['flow_mod']:>10}{messages['group_mod']:>10}{messages['packet_out']:>9}"
+              f"{messages['barrier']:>9}{messages['bytes'] / 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of ryu_multipath.py')
+    parser.add_argument('--topology', choices=sorted(topologies), default='grid')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help='grid side length, fat-tree k or KIT scale factor')
+    parser.add_argument('--hosts', type=int, default=32)
+    parser.add_argument('--pairs', type=int, default=100)
+    parser.add_argument('--failures', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the second run that traces the memory')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the controller')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    all_results = []
+    for size in args.sizes or default_sizes[args.topology]:
+        result = run(topologies[args.topology](size), args, args.seed)
+        if args.memory:
+            result['memory'] = run(topologies[args.topology](size), args, args.seed, True)['memory']
+        print_result(result)
+        all_results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2)
+        print(f"[+] Results written to {args.output}")
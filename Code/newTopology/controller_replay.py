@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+from ryu.app.wsgi import WSGIApplication
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER
+from ryu.ofproto import ofproto_v1_3, ofproto_parser
+from ryu.topology import event
+from ryu.topology.switches import Switch, Link, Port
+from collections import defaultdict
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import time
+
+import ryu_multipath
+from controller_benchmark import FakeDatapath, PortDesc, acknowledge_barriers, count_messages
+from ryu_multipath import EventRecorder
+
+'''
+Replay of an event log into a fresh ProjectController, without root, Mininet or OVS.
+Record a live run by setting EVENT_LOG_FILE in ryu_multipath.py, e.g. during a backup scenario of newTopo.py,
+then feed the log to the controller of the current tree to compare routing changes against the same events.
+The switches are fake datapaths that count the messages they would send and answer every barrier at once.
+
+python3 controller_replay.py backup.evlog
+python3 controller_replay.py backup.evlog --speed 1 --output replay.json
+
+--speed 0 (default) replays as fast as possible, --speed 1 at the recorded speed, 2 twice as fast.
+'''
+
+def get_handlers(app):
+    # the handlers ryu would call for an event class once the switches are connected
+    handlers = defaultdict(list)
+    for name, method in inspect.getmembers(app, inspect.ismethod):
+        for ev_cls, caller in getattr(method, 'callers', {}).items():
+            if not caller.dispatchers or MAIN_DISPATCHER in caller.dispatchers:
+                handlers[ev_cls].append(method)
+    return handlers
+
+
+def get_datapath(datapaths, dpid):
+    if dpid not in datapaths:
+        datapaths[dpid] = FakeDatapath(dpid)
+    return datapaths[dpid]
+
+
+def make_event(datapaths, kind, dpid, payload):
+    dp = get_datapath(datapaths, dpid)
+    if kind == EventRecorder.SWITCH_ENTER:
+        return 'switch_enter', event.EventSwitchEnter(Switch(dp))
+    if kind == EventRecorder.SWITCH_LEAVE:
+        return 'switch_leave', event.EventSwitchLeave(Switch(dp))
+    if kind in (EventRecorder.LINK_ADD, EventRecorder.LINK_DELETE):
+        port1, dpid2, port2 = EventRecorder.LINK.unpack(payload)
+        link = Link(Port(dpid, ofproto_v1_3, PortDesc(port1)),
+                    Port(dpid2, ofproto_v1_3, PortDesc(port2)))
+        if kind == EventRecorder.LINK_ADD:
+            return 'link_add', event.EventLinkAdd(link)
+        return 'link_delete', event.EventLinkDelete(link)
+    version, msg_type, msg_len, xid = ofproto_parser.header(payload)
+    msg = ofproto_parser.msg(dp, version, msg_type, msg_len, xid, payload)
+    ev = ofp_event.ofp_msg_to_ev(msg)
+    return type(ev).__name__[len('EventOFP'):], ev
+
+
+def get_resync_xid(app, dpid):
+    # the flow stats request of the replay's latest resync of the switch
+    xids = [xid for d, xid in app.resync_xids if d == dpid]
+    return max(xids) if xids else None
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def replay(path, speed, verbose=False):
+    # the replay starts cold and is synchronous, like the benchmark
+    ryu_multipath.SNAPSHOT_FILE = None
+    ryu_multipath.EVENT_LOG_FILE = None
+    ryu_multipath.PATH_WORKERS = 0
+    app = ryu_multipath.ProjectController(wsgi=WSGIApplication())
+    handlers = get_handlers(app)
+    datapaths = {}
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    # (dpid, xid) of the resync requests of the recorded run
+    resyncs = set()
+    first = None
+    lag = 0.0
+
+    output = open(os.devnull, 'w') if not verbose else None
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        for timestamp, kind, dpid, payload in EventRecorder.read(path):
+            if first is None:
+                first = timestamp
+            last = timestamp
+            if speed:
+                delay = start + (timestamp - first) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            if kind == EventRecorder.RESYNC:
+                resyncs.add((dpid, EventRecorder.XID.unpack(payload)[0]))
+                continue
+            name, ev = make_event(datapaths, kind, dpid, payload)
+            if kind == EventRecorder.OPENFLOW and (dpid, ev.msg.xid) in resyncs:
+                # a reply to the recorded resync answers the replayed one
+                ev.msg.xid = get_resync_xid(app, dpid)
+            handled = time.perf_counter()
+            for handler in handlers[type(ev)]:
+                try:
+                    handler(ev)
+                except Exception as e:
+                    # ryu logs the exception and keeps dispatching, so does the replay
+                    errors[name] += 1
+                    if verbose:
+                        print("Handler", handler.__name__, "failed:", repr(e))
+            acknowledge_barriers(app, datapaths)
+            durations[name].append(time.perf_counter() - handled)
+    seconds = time.perf_counter() - start
+    if output:
+        output.close()
+
+    events = {}
+    for name, values in durations.items():
+        values.sort()
+        events[name] = {
+            'count': len(values),
+            'seconds': sum(values),
+            'p50': percentile(values, 0.5),
+            'p99': percentile(values, 0.99),
+            'max': values[-1],
+            'errors': errors[name],
+        }
+    return {
+        'log': path,
+        'speed': speed,
+        'events': sum(len(values) for values in durations.values()),
+        'recorded_seconds': last - first if first is not None else 0.0,
+        'replay_seconds': seconds,
+        'max_lag_seconds': lag,
+        'flows': sum(len(flows) for flows in app.flows.values()),
+        'groups': len(app.group_refs),
+        'resynced': len(app.resynced),
+        'messages': count_messages(datapaths),
+        'per_event': events,
+    }
+
+
+def print_result(result):
+    messages = result['messages']
+    print(f"[+] {result['log']}: {result['events']} events recorded over {result['recorded_seconds']:.1f} s, "
+          f"replayed in {result['replay_seconds']:.2f} s" +
+          (f" (max lag {result['max_lag_seconds'] * 1000:.1f} ms)" if result['speed'] else ''))
+    print(f"    {result['flows']} flows, {result['groups']} groups, {result['resynced']} resynced switches, "
+          f"{messages['flow_mod']} flow_mod, "
+          f"{messages['group_mod']} group_mod, {messages['packet_out']} packet_out, "
+          f"{messages['barrier']} barrier, {messages['bytes'] / 1000:.1f} kbytes")
+    print(f"    {'event':<22}{'count':>8}{'total ms':>11}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+    for name, stats in sorted(result['per_event'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"    {name:<22}{stats['count']:>8}{stats['seconds'] * 1000:>11.1f}{stats['p50'] * 1000:>9.3f}"
+              f"{stats['p99'] * 1000:>9.3f}{stats['max'] * 1000:>9.3f}{stats['errors']:>8}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay an event log of ryu_multipath.py')
+    parser.add_argument('log', help='file written with EVENT_LOG_FILE')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1 replays at the recorded speed, 0 as fast as possible')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the controller')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    result = replay(args.log, args.speed, args.verbose)
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"[+] Results written to {args.output}")
@@ -7,9 +7,12 @@ from mininet.node import OVSSwitch
 from mininet.log import lg
 from mininet.topo import Topo
 from mininet.link import TCLink
+import json
 import os
 import random
 import time
+import urllib.error
+import urllib.request
 
 ''' Topology (Grid):
 LN1  --  LN2  --  LN3  --  LN4  
@@ -36,6 +39,7 @@ stddelay = '2ms'
 numberOfClients = 3 # default value
 stdQueueSize = 4444 # max queue size is in packets, so 1500 Byte (MTU) * 13333333 = 20 GB
 stdbw = 33 # in MBit/s, max 1000 MBit/s
+controller_api = 'http://127.0.0.1:8080' # REST API of ryu_multipath.py (ryu-manager --wsapi-port)
 
 class MyTopo(Topo):
     def __init__(self):
@@ -118,6 +122,43 @@ def configure_servers(net):
         net['SCC_N2'].cmd(f"iperf3 -s -p {port} -V --json > scc_n2.json &")
         net['BWCLOUD'].cmd(f"iperf3 -s -p {port} -V --json > bwcloud.json &")
 
+    '''
+    Pfad-Vorinstallation:
+    Die Szenarien kennen alle Client-Server-Paare bevor iperf3 startet. Der Controller installiert deren Pfade vorab
+    in einem Schritt und antwortet erst, wenn die Switches die Regeln bestaetigt haben, so dass die Messungen nicht
+    die Latenz der ersten Pakete (ARP, Packet-In, Pfadberechnung) enthalten.
+    '''
+def host_info(net, name):
+    host = net[name]
+    intf = host.defaultIntf()
+    link = intf.link
+    switch_intf = link.intf2 if link.intf1 is intf else link.intf1
+    switch = switch_intf.node
+    return {'ip': host.IP(), 'mac': host.MAC(), 'dpid': int(switch.dpid, 16),
+            'port': switch.ports[switch_intf]}
+
+def preinstall_paths(net, pairs):
+    """ Installs the paths of all (client, server) pairs via the controller's REST API """
+    
+    names = sorted(set(name for pair in pairs for name in pair))
+    body = {
+        'hosts': [host_info(net, name) for name in names],
+        'pairs': [{'ip_src': net[client].IP(), 'ip_dst': net[server].IP()} for client, server in sorted(set(pairs))],
+    }
+    req = urllib.request.Request(controller_api + '/multipath/paths', data=json.dumps(body).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            result = json.load(resp)
+    except (urllib.error.URLError, OSError) as e:
+        print(f"[!] Pre-installation of the paths failed: {e}")
+        return None
+    print(f"[+] Pre-installed {len(result['installed'])} paths in {result['seconds']:.3f}s (acknowledged: {result['acknowledged']})")
+    if result['unresolved']:
+        print(f"[!] No path for {result['unresolved']}")
+    return result
+
+
     '''
     Netzwerk Szenarios:
     
@@ -133,6 +174,8 @@ def scenario_backup(net, numberOfClients):
     
     FILE_ip = "10.0.0.3"
     port = 5201 # default iperf3 port
+    pairs = []
+    commands = []
     
     for j in range(1, numberOfClients + 1):
         clients = [f'LN2C{j}', f'LN9C{j}', f'LN12C{j}'] # Only North Campus!
@@ -149,12 +192,17 @@ def scenario_backup(net, numberOfClients):
                 
                 if debug:
                     print(f"[DEBUG] Starting iperf3 from {client} to FILE server with {parallel_streams} streams and {bandwidth} bandwidth on port {port}...")
-                net[client].cmd(f"iperf3 -c 10.0.0.3 -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_backup_folder/backup_results_{client}.json &")
+                pairs.append((client, 'FILE'))
+                commands.append((client, f"iperf3 -c 10.0.0.3 -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_backup_folder/backup_results_{client}.json &"))
                 
-                net[client].cmd(f"ping -c {scenario_time} 10.0.0.3 > scenario_backup_folder/ping_backup_results_{client}.txt &")
+                commands.append((client, f"ping -c {scenario_time} 10.0.0.3 > scenario_backup_folder/ping_backup_results_{client}.txt &"))
                 
                 port = port + 1 # Take the next free port
 
+    preinstall_paths(net, pairs)
+    for client, command in commands:
+        net[client].cmd(command)
+
     
     '''
     2.  Arbeitsalltag
@@ -178,6 +226,8 @@ def scenario_normal(net, numberOfClients):
     "SCC_N2": "10.0.0.15", 
     "BWCLOUD": "10.0.0.1"
      }
+    pairs = []
+    commands = []
 
     
     for j in range(1, numberOfClients + 1):
@@ -201,10 +251,15 @@ def scenario_normal(net, numberOfClients):
                 if debug:
                     print(f"[DEBUG] Starting iperf3 from {client} to {server} server with {parallel_streams} streams and {bandwidth} bandwidth...")
                 
-                net[client].cmd(f"iperf3 -c {server_ip} -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_normal_folder/normal_results_{client}.json &")
+                pairs += [(client, server), (client, 'FILE')]
+                commands.append((client, f"iperf3 -c {server_ip} -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_normal_folder/normal_results_{client}.json &"))
                 
-                net[client].cmd(f"ping -c {scenario_time} 10.0.0.3 > scenario_normal_folder/ping_normal_results_{client}.txt &")
+                commands.append((client, f"ping -c {scenario_time} 10.0.0.3 > scenario_normal_folder/ping_normal_results_{client}.txt &"))
                 port = port + 1 # Take the next free port
+
+    preinstall_paths(net, pairs)
+    for client, command in commands:
+        net[client].cmd(command)
     
     
     '''
@@ -230,6 +285,8 @@ def scenario_emergency(net, numberOfClients):
         "SCC_N2": "10.0.0.15",
         "BWCLOUD": "10.0.0.1"
     }
+    pairs = []
+    commands = []
 
     for j in range(1, numberOfClients + 1):
         clients = [f'LN2C{j}', f'LN9C{j}', f'LN12C{j}']  # Only North Campus!
@@ -243,11 +300,16 @@ def scenario_emergency(net, numberOfClients):
                 parallel_streams = random.randint(1, 5)  # Random number of parallel connections
                 bandwidth = random.choice(["0.625MB", "3.25MB", "9.875MB", "19.75MB", "33MB"])
 
-                net[client].cmd(f"iperf3 -c {server_ip} -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_link_failure_folder/fail_results_{client}.json &")
-                net[client].cmd(f"ping -c {scenario_time} FILE > scenario_link_failure_folder/ping_fail_results_{client}.txt &")
+                pairs += [(client, server), (client, 'FILE')]
+                commands.append((client, f"iperf3 -c {server_ip} -p {port} -P {parallel_streams} -b {bandwidth} -t {scenario_time} -V --json > scenario_link_failure_folder/fail_results_{client}.json &"))
+                commands.append((client, f"ping -c {scenario_time} FILE > scenario_link_failure_folder/ping_fail_results_{client}.txt &"))
                 
                 port += 1  # Take the next free port
 
+    preinstall_paths(net, pairs)
+    for client, command in commands:
+        net[client].cmd(command)
+
     # Warten bis zur Hälfte der Szenariozeit
     time.sleep(scenario_time / 2)
     print("[+] Simulating link failure...")
@@ -264,6 +326,66 @@ def scenario_emergency(net, numberOfClients):
 
 
 
+    '''
+    Failover-Messung: Ein Client pingt einen Server alle 10 ms an, in der Mitte der Messung faellt ein Link der Route aus.
+    Aus den verlorenen Pings ergibt sich die Unterbrechungsdauer. Einmal mit GROUP_MODE = 'select' und einmal mit
+    GROUP_MODE = 'fast_failover' in ryu_multipath.py ausfuehren, um beide Modi zu vergleichen.
+    '''
+def measure_failover(net, client='LN2C1', server='FILE', link=('LN2', 'LN6'), duration=10, interval=0.01):
+
+    print(f"[+] Measuring packet loss during failover of link {link[0]} <-> {link[1]}...")
+    os.system("mkdir -p failover_folder")
+
+    count = int(duration / interval)
+    log = f"failover_folder/ping_failover_{client}.txt"
+    server_ip = net[server].IP()
+
+    net[client].cmd(f"ping -c 1 {server_ip}")  # make sure the path is installed
+    net[client].cmd(f"ping -i {interval} -c {count} {server_ip} > {log} &")
+    time.sleep(duration / 2)
+    net.configLinkStatus(link[0], link[1], 'down')
+    print(f"[-] Link between {link[0]} and {link[1]} is now DOWN!")
+    time.sleep(duration / 2 + 2)
+    net.configLinkStatus(link[0], link[1], 'up')
+
+    with open(log) as f:
+        for line in f:
+            if "packet loss" in line:
+                transmitted = int(line.split()[0])
+                received = int(line.split()[3])
+                lost = transmitted - received
+                print(f"[+] {lost} of {transmitted} packets lost, ~{lost * interval * 1000:.0f} ms of interruption")
+                return lost
+    print("[!] No ping statistics found in " + log)
+
+
+    '''
+    QoS-Queues: Jeder Switch-Port bekommt drei OVS-Queues (linux-htb), auf die ryu_multipath.py mit QOS_ENABLED = True
+    die Klassen aus QOS_CLASSES abbildet: 0 Standard, 1 Interaktiv (Ping, bevorzugt), 2 Bulk (Backups, begrenzt).
+    OVS ersetzt dabei die tc-Konfiguration des TCLinks auf der Switch-Seite, die Bandbreite stdbw bleibt als max-rate
+    erhalten, das Delay gilt danach nur noch auf der Host-Seite der Links.
+    '''
+qos_queues = {0: 'other-config:priority=1',
+              1: f'other-config:priority=0 other-config:min-rate={stdbw * 300000}',
+              2: f'other-config:priority=2 other-config:max-rate={stdbw * 700000}'}
+
+def configure_qos(net):
+    """ Creates the queues of the QoS classes on all switch ports """
+
+    print("[+] Configuring QoS queues...")
+    for switch in net.switches:
+        for intf in switch.intfList():
+            if intf.name == 'lo':
+                continue
+            queues = ' '.join(f'queues:{queue}=@q{queue}' for queue in qos_queues)
+            command = (f'ovs-vsctl -- set port {intf.name} qos=@qos -- --id=@qos create qos type=linux-htb '
+                       f'other-config:max-rate={stdbw * 1000000} {queues}')
+            for queue, config in qos_queues.items():
+                command += f' -- --id=@q{queue} create queue {config}'
+            switch.cmd(command)
+
+
+
 
 class CustomCLI(CLI):
         
@@ -301,6 +423,18 @@ class CustomCLI(CLI):
         else:
             print("[!] Unknown scenario. Usage: scenario [1|2|3]")
 
+    def do_failover(self, arg):
+        """Measure packet loss during a link failure. Usage: failover [client] [server]"""
+        args = arg.split()
+        if len(args) == 2:
+            measure_failover(self.mn, client=args[0], server=args[1])
+        else:
+            measure_failover(self.mn)
+
+    def do_qos(self, arg):
+        """Create the QoS queues on all switch ports (needs QOS_ENABLED in ryu_multipath.py). Usage: qos"""
+        configure_qos(self.mn)
+
 
 
 
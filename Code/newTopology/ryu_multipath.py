@@ -10,19 +10,32 @@ from ryu.lib.packet import arp
 from ryu.lib.packet import ethernet
 from ryu.lib.packet import ipv4
 from ryu.lib.packet import ipv6
+from ryu.lib.packet import tcp
+from ryu.lib.packet import udp
 from ryu.lib.packet import ether_types
 from ryu.lib import mac, ip
+from ryu.lib import hub
 from ryu.topology.api import get_switch, get_link
-from ryu.app.wsgi import ControllerBase
+from ryu.app.wsgi import ControllerBase, WSGIApplication, Response, route
 from ryu.topology import event
 
-from collections import defaultdict
+from eventlet import tpool
+
+from collections import defaultdict, deque, OrderedDict
 from operator import itemgetter
 
+import bisect
+import heapq
+import json
 import os
-import random
+import struct
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 '''
 ryu_multipath.py is taken from 
@@ -37,69 +50,1260 @@ DEFAULT_BW = 10000000
 
 MAX_PATHS = 5
 
-class ProjectController(app_manager.RyuApp):
-    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+# Path computation: 'ksp' computes the MAX_PATHS cheapest loopless paths with
+# Yen's algorithm, 'dfs' enumerates all simple paths (legacy, exponential)
+PATH_ALGORITHM = 'ksp'
 
-    def __init__(self, *args, **kwargs):
-        super(ProjectController, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
-        self.topology_api_app = self
-        self.datapath_list = {}
-        self.arp_table = {}
-        self.switches = []
-        self.hosts = {}
-        self.multipath_group_ids = {}
-        self.group_ids = []
-        self.adjacency = defaultdict(dict)
-        self.bandwidths = defaultdict(lambda: defaultdict(lambda: DEFAULT_BW))
+# Max number of (src, dst) switch pairs kept in the path cache
+PATH_CACHE_SIZE = 1024
+
+# Native threads computing the paths packet-ins need off the event loop, the
+# packet is forwarded once they are known. 0 computes them inline
+PATH_WORKERS = 4
+
+# A pair whose paths were installed less than INSTALL_COALESCE_WINDOW seconds
+# ago for the same topology and link costs is not installed again, e.g. by
+# the ARP request and the ARP reply of the same exchange. The duplicate joins
+# the outstanding install instead. 0 disables the coalescing
+INSTALL_COALESCE_WINDOW = 1
+
+# Proactive mode: once no switch/link event arrived for PROACTIVE_SETTLE_TIME
+# seconds, install the paths between all known hosts without waiting for ARP
+PROACTIVE_MODE = False
+PROACTIVE_SETTLE_TIME = 5
+
+# Interval in seconds for polling port statistics, the measured load lowers
+# the residual bandwidth used in the link costs. None disables polling
+PORT_STATS_INTERVAL = 2
+
+# EWMA weight of the newest port utilization sample
+UTILIZATION_ALPHA = 0.3
+
+# Capacity of every port in kbit/s. OVS reports 10 Gbps as curr_speed while the
+# TCLinks in newTopo.py are capped at 33 Mbit/s. None uses curr_speed
+LINK_CAPACITY = 33000
+
+# Lower bound of the residual bandwidth as share of the capacity
+MIN_RESIDUAL_SHARE = 0.01
+
+# Relative change of a port's residual bandwidth that invalidates cached paths
+COST_CHANGE_THRESHOLD = 0.2
+
+# Link cost: 'bandwidth' is REFERENCE_BW / residual bandwidth, 'delay' the
+# measured link delay in ms, 'weighted' the bandwidth cost plus
+# DELAY_COST_PER_MS for every ms of delay (an idle 33 Mbit/s link costs 303)
+LINK_COST_MODE = 'bandwidth'
+DELAY_COST_PER_MS = 100
+
+# Interval in seconds for measuring the link delays with probe packets between
+# the switches, minus the echo RTT of the switches. Only probed when
+# LINK_COST_MODE uses the delay, None disables probing
+DELAY_PROBE_INTERVAL = 2
+DELAY_ALPHA = 0.3
+
+# Delay in ms of a link that was not measured yet, like the links of newTopo.py
+DEFAULT_LINK_DELAY = 2
+
+# Ethertype of the delay probes (IEEE local experimental)
+PROBE_ETHERTYPE = 0x88b5
+
+# Group mode: 'select' balances the load over the MAX_PATHS paths,
+# 'fast_failover' installs the cheapest path with a precomputed backup next
+# hop per switch that the switch itself activates when the watched port fails
+GROUP_MODE = 'select'
+
+# Resolution of the SELECT bucket weights
+BUCKET_WEIGHT_SCALE = 1000
+
+# Interval in seconds for rebalancing the SELECT bucket weights with the
+# measured residual bandwidth of the bucket paths, needs PORT_STATS_INTERVAL.
+# None keeps the weights computed at installation
+REBALANCE_INTERVAL = 5
+
+# Change of a bucket's share of the weights that triggers an OFPGC_MODIFY
+REBALANCE_THRESHOLD = 0.1
+
+# Elephant flows: every ELEPHANT_INTERVAL seconds the ingress rules of the
+# host pairs are polled. The ingress switch of a pair faster than ELEPHANT_RATE
+# kbit/s copies the pair's packets to the controller until every 5-tuple has
+# its own counting rule there. 5-tuples faster than ELEPHANT_RATE are pinned to
+# the least loaded of the pair's paths, the other flows stay on the SELECT
+# group. Only with GROUP_MODE 'select' and FORWARDING_MODE 'pair', None
+# (the default) disables the detection
+ELEPHANT_INTERVAL = None
+ELEPHANT_RATE = 10000
+
+# Idle timeout in seconds of the per 5-tuple rules
+MICROFLOW_IDLE_TIMEOUT = 10
+
+# Priorities above the pair rules (32768) and the in_port backup rules (32769)
+SPLIT_PRIORITY = 32770
+MICROFLOW_PRIORITY = 32771
+ELEPHANT_PRIORITY = 32772
+
+# Cookie of the rules that copy the packets of split pairs to the controller
+SPLIT_COOKIE = 0x5e1f
+
+# QoS: with QOS_ENABLED the switches classify IPv4 packets in table 0 and
+# forward them in table 1. A packet of a class leaves every switch through the
+# OVS queue of the class (created by the qos command of newTopo.py), and the
+# switch where it enters from a host polices it with the meter of the class.
+# The first matching class wins, a class matches on ip_dst, ip_proto, a
+# destination port_range and/or dscp. rate is in kbit/s and burst in kbit, a
+# class without rate is not policed. Packets of no class use queue 0
+QOS_ENABLED = False
+QOS_CLASSES = [
+    # ping and other latency probes
+    {'name': 'interactive', 'ip_proto': 1, 'queue': 1},
+    # iperf3 backups to FILE in scenario_backup of newTopo.py
+    {'name': 'bulk', 'ip_dst': '10.0.0.3', 'ip_proto': 6, 'port_range': (5201, 5210),
+     'queue': 2, 'rate': 20000, 'burst': 2000},
+]
+
+# Priority of the first class in the classifier table
+QOS_PRIORITY = 100
+
+# Idle timeout in seconds of the path flows on the ingress switch. When it
+# expires the controller removes the pair's flows from all other switches and
+# deletes groups no flow refers to anymore. 0 never expires
+FLOW_IDLE_TIMEOUT = 60
+
+# Hard timeout in seconds of all path flows, 0 never expires
+FLOW_HARD_TIMEOUT = 0
+
+# Seconds a released group id stays unused, so a delete that is still queued
+# behind a barrier never hits a group that reuses the id
+GROUP_ID_REUSE_DELAY = 10
+
+# Flooding: 'tree' floods broadcasts and unknown destinations only along a
+# spanning tree of the switch links, 'flood' uses OFPP_FLOOD (legacy, the
+# packets circle in the grid)
+FLOOD_MODE = 'tree'
+
+# Priority of the broadcast rules on the spanning tree links
+FLOOD_PRIORITY = 3
+
+# Forwarding: 'pair' installs exact-match rules per (ip_src, ip_dst) on the
+# switches of its paths, 'destination' installs one rule per destination IP on
+# every switch along a shortest-path tree rooted at the destination, so the
+# flow tables grow with the number of hosts instead of host pairs
+FORWARDING_MODE = 'pair'
+
+# In destination mode a neighbor closer to the destination is used as
+# additional ECMP next hop if its path is at most this much more expensive
+ECMP_TOLERANCE = 0.1
+
+# Answer ARP requests for known IPs from the controller instead of flooding them
+ARP_PROXY = True
+
+# Warm restart: the learned hosts, links and installed pairs are written to
+# SNAPSHOT_FILE every SNAPSHOT_INTERVAL seconds if they changed, and reloaded
+# on start. Reconnecting switches keep their flows and groups, the controller
+# reads them back with stats requests, e.g. 'ryu_multipath_state.json'.
+# None disables the snapshots
+SNAPSHOT_FILE = None
+SNAPSHOT_INTERVAL = 10
+
+# Seconds a link of the snapshot is used without LLDP rediscovering it
+SNAPSHOT_LINK_TIMEOUT = 15
+
+# Print the packet-in counters every PACKET_IN_REPORT packet-ins
+PACKET_IN_REPORT = 1000
+
+# Record every event the controller handles into this binary log, for
+# replaying a live run offline with controller_replay.py. None disables it
+EVENT_LOG_FILE = None
+
+# Statistics collector: every STATS_INTERVAL seconds the flow, group and port
+# statistics of all switches are requested and appended column-wise to
+# STATS_FILE, a strftime pattern so every run gets its own file. Read it with
+# StatsWriter.read. None disables the collector
+STATS_INTERVAL = None
+STATS_FILE = 'ryu_multipath_stats_%Y%m%d_%H%M%S.bin'
+
+# URL of the metrics in the Prometheus text format, served by the ryu WSGI
+# server (ryu-manager --wsapi-port, default 8080)
+METRICS_URL = '/metrics'
+
+# Upper bounds in seconds of the histogram buckets
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# URL for pre-installing the paths of host pairs with a POST request, and the
+# default time in seconds the request waits for the switches' barrier replies
+PREINSTALL_URL = '/multipath/paths'
+PREINSTALL_TIMEOUT = 10
+
+multipath_instance_name = 'multipath_api_app'
+
+
+def get_actions_signature(actions):
+    '''
+    Get a comparable description of OpenFlow actions, to detect rules the
+    switch already holds
+    '''
+    return [(type(action).__name__, sorted(vars(action).items())) for action in actions]
+
+
+def get_buckets_signature(buckets):
+    return [(bucket.weight, bucket.watch_port, bucket.watch_group,
+             get_actions_signature(bucket.actions)) for bucket in buckets]
+
+
+def get_port_masks(first, last):
+    '''
+    Split the port range first..last into (port, mask) pairs of aligned
+    blocks for masked matches
+    '''
+    masks = []
+    while first <= last:
+        size = first & -first or 0x10000
+        while first + size - 1 > last:
+            size //= 2
+        masks.append((first, 0xffff & ~(size - 1)))
+        first += size
+    return masks
+
+
+def get_qos_matches(qos_class):
+    '''
+    Get the match fields of a QoS class, one dict per block of its port range
+    '''
+    fields = {'eth_type': 0x0800}
+    if 'ip_dst' in qos_class:
+        fields['ipv4_dst'] = qos_class['ip_dst']
+    if 'dscp' in qos_class:
+        fields['ip_dscp'] = qos_class['dscp']
+    if 'ip_proto' in qos_class:
+        fields['ip_proto'] = qos_class['ip_proto']
+    if 'port_range' not in qos_class:
+        return [fields]
+    if qos_class.get('ip_proto') not in (6, 17):
+        raise ValueError(f"QoS class {qos_class['name']}: port_range needs ip_proto 6 or 17")
+    port_field = 'tcp_dst' if qos_class['ip_proto'] == 6 else 'udp_dst'
+    return [dict(fields, **{port_field: port if mask == 0xffff else (port, mask)})
+            for port, mask in get_port_masks(*qos_class['port_range'])]
+
+
+class PathCache(object):
+    '''
+    LRU cache of the optimal paths and their costs per (src, dst) switch pair.
+    Entries computed for an older topology version count as misses
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, src, dst):
+        entry = self.entries.get((src, dst))
+        if entry is None or entry[0] != self.version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((src, dst))
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def contains(self, src, dst):
+        entry = self.entries.get((src, dst))
+        return entry is not None and entry[0] == self.version
+
+    def put(self, src, dst, paths, costs):
+        self.entries[src, dst] = (self.version, paths, costs)
+        self.entries.move_to_end((src, dst))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def bump_version(self):
+        '''
+        Invalidate all entries, e.g. when a new link may offer cheaper paths
+        '''
+        self.version += 1
+
+    def invalidate_link(self, s1, s2):
+        '''
+        Drop the entries with a path over the link s1 <-> s2
+        '''
+        for key, (version, paths, costs) in list(self.entries.items()):
+            for path in paths:
+                hops = set(zip(path[:-1], path[1:]))
+                if (s1, s2) in hops or (s2, s1) in hops:
+                    del self.entries[key]
+                    break
+
+    def invalidate_switch(self, dpid):
+        '''
+        Drop the entries with a path over the switch dpid
+        '''
+        for key, (version, paths, costs) in list(self.entries.items()):
+            if any(dpid in path for path in paths):
+                del self.entries[key]
+
+
+class TopologySnapshot(object):
+    '''
+    Copy of the switch graph and its link costs at one topology version, as
+    CSR arrays over dense switch indices: the out links of switch i are the
+    edges indptr[i] to indptr[i + 1], with the neighbor in indices, the out
+    port in ports, the opposite edge in reverse and the cost in cost.
+    It is never modified, so the path algorithms can run on it in worker
+    threads while the event loop keeps changing the live topology
+    '''
+
+    def __init__(self, version, adjacency, switches, structure=None):
+        self.version = version
+        if structure is None:
+            structure = self.build_structure(adjacency, switches)
+        (self.nodes, self.index, self.indptr, self.indices, self.ports,
+         self.reverse, self.edges, self.connected) = structure
+        self.cost = None
+
+    @staticmethod
+    def build_structure(adjacency, switches):
+        nodes = sorted(set(adjacency) | set(switches) |
+                       set(s2 for links in adjacency.values() for s2 in links))
+        index = dict((dpid, i) for i, dpid in enumerate(nodes))
+        indptr = [0]
+        indices = []
+        ports = []
+        for dpid in nodes:
+            for s2, port in adjacency.get(dpid, {}).items():
+                indices.append(index[s2])
+                ports.append(port)
+            indptr.append(len(indices))
+        edges = {}
+        for i in range(len(nodes)):
+            for e in range(indptr[i], indptr[i + 1]):
+                edges[i, indices[e]] = e
+        reverse = [edges.get((indices[e], i), -1) for i in range(len(nodes))
+                   for e in range(indptr[i], indptr[i + 1])]
+        connected = [dpid in switches for dpid in nodes]
+        return nodes, index, indptr, indices, ports, reverse, edges, connected
+
+    def get_structure(self):
+        return (self.nodes, self.index, self.indptr, self.indices, self.ports,
+                self.reverse, self.edges, self.connected)
+
+    def get_out_links(self):
+        '''
+        Get (dpid, out_port, neighbor, neighbor_port) per edge in edge order
+        '''
+        nodes = self.nodes
+        links = []
+        for i, dpid in enumerate(nodes):
+            for e in range(self.indptr[i], self.indptr[i + 1]):
+                r = self.reverse[e]
+                links.append((dpid, self.ports[e], nodes[self.indices[e]],
+                              self.ports[r] if r >= 0 else None))
+        return links
+
+    @property
+    def adjacency(self):
+        '''
+        The graph as {dpid: {neighbor: out_port}} like the controller's
+        adjacency, for code that does not need the arrays
+        '''
+        nodes = self.nodes
+        return dict((dpid, dict((nodes[self.indices[e]], self.ports[e])
+                                for e in range(self.indptr[i], self.indptr[i + 1])))
+                    for i, dpid in enumerate(nodes))
+
+    def get_link_cost(self, s1, s2):
+        return self.cost[self.edges[self.index[s1], self.index[s2]]]
 
     def get_paths(self, src, dst):
         '''
-        Get all paths from src to dst using DFS algorithm    
+        Get all paths from src to dst using DFS algorithm
         '''
         if src == dst:
             # host target is on the same switch
             return [[src]]
+        if src not in self.index or dst not in self.index:
+            return []
+        indptr = self.indptr
+        indices = self.indices
+        s = self.index[src]
+        t = self.index[dst]
+        on_path = [False] * len(self.nodes)
+        on_path[s] = True
+        path = [s]
+        stack = [iter(range(indptr[s], indptr[s + 1]))]
         paths = []
-        stack = [(src, [src])]
         while stack:
-            (node, path) = stack.pop()
-            for next in set(self.adjacency[node].keys()) - set(path):
-                if next is dst:
-                    paths.append(path + [next])
-                else:
-                    stack.append((next, path + [next]))
-        #print ("Available paths from ", src, " to ", dst, " : ", paths)
-        return paths
+            for e in stack[-1]:
+                next = indices[e]
+                if on_path[next]:
+                    continue
+                if next == t:
+                    paths.append(path + [t])
+                    continue
+                on_path[next] = True
+                path.append(next)
+                stack.append(iter(range(indptr[next], indptr[next + 1])))
+                break
+            else:
+                stack.pop()
+                on_path[path.pop()] = False
+        return [self.to_dpids(p) for p in paths]
 
-    def get_link_cost(self, s1, s2):
+    def to_dpids(self, path):
+        nodes = self.nodes
+        return [nodes[i] for i in path]
+
+    def shortest_path(self, s, t, excluded_nodes=(), excluded_edges=()):
+        '''
+        Dijkstra from index s to index t, skipping the excluded node indices
+        and edge ids. Returns (cost, path of indices) or None
+        '''
+        indptr = self.indptr
+        indices = self.indices
+        edge_cost = self.cost
+        dist = [None] * len(self.nodes)
+        dist[s] = 0
+        prev = {}
+        heap = [(0, s)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node == t:
+                path = [t]
+                while path[-1] != s:
+                    path.append(prev[path[-1]])
+                return cost, path[::-1]
+            if cost > dist[node]:
+                continue
+            for e in range(indptr[node], indptr[node + 1]):
+                next = indices[e]
+                if next in excluded_nodes or e in excluded_edges:
+                    continue
+                next_cost = cost + edge_cost[e]
+                if dist[next] is None or next_cost < dist[next]:
+                    dist[next] = next_cost
+                    prev[next] = node
+                    heapq.heappush(heap, (next_cost, next))
+        return None
+
+    def get_shortest_path(self, src, dst, excluded_nodes=(), excluded_links=()):
         '''
-        Get the link cost between two switches 
+        Get the cheapest path from src to dst using Dijkstra on the link costs,
+        ignoring the given nodes and directed links. Returns (cost, path) or None
         '''
-        e1 = self.adjacency[s1][s2]
-        e2 = self.adjacency[s2][s1]
-        bl = min(self.bandwidths[s1][e1], self.bandwidths[s2][e2])
-        ew = REFERENCE_BW/bl
-        return ew
+        index = self.index
+        if src not in index or dst not in index:
+            return None
+        excluded_edges = set(self.edges.get((index[s1], index[s2]))
+                             for s1, s2 in excluded_links if s1 in index and s2 in index)
+        shortest = self.shortest_path(
+            index[src], index[dst],
+            set(index[node] for node in excluded_nodes if node in index), excluded_edges)
+        if shortest is None:
+            return None
+        return shortest[0], self.to_dpids(shortest[1])
+
+    def get_k_shortest_paths(self, src, dst, k):
+        '''
+        Get the k cheapest loopless paths from src to dst using Yen's algorithm
+        '''
+        if src == dst:
+            # host target is on the same switch
+            return [[src]]
+        if src not in self.index or dst not in self.index:
+            return []
+        edges = self.edges
+        t = self.index[dst]
+        shortest = self.shortest_path(self.index[src], t)
+        if shortest is None:
+            return []
+        paths = [shortest[1]]
+        candidates = []
+        seen = {tuple(shortest[1])}
+        while len(paths) < k:
+            last = paths[-1]
+            for i in range(len(last) - 1):
+                spur_node = last[i]
+                root = last[:i + 1]
+                # forbid the next hop of every known path sharing this root
+                excluded_edges = set(
+                    edges[p[i], p[i + 1]] for p in paths if p[:i + 1] == root)
+                spur = self.shortest_path(spur_node, t, set(root[:-1]), excluded_edges)
+                if spur is None:
+                    continue
+                path = root[:-1] + spur[1]
+                if tuple(path) not in seen:
+                    seen.add(tuple(path))
+                    heapq.heappush(candidates, (self.index_path_cost(path), path))
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates)[1])
+        return [self.to_dpids(p) for p in paths]
+
+    def index_path_cost(self, path):
+        edges = self.edges
+        edge_cost = self.cost
+        return sum(edge_cost[edges[s1, s2]] for s1, s2 in zip(path[:-1], path[1:]))
 
     def get_path_cost(self, path):
         '''
         Get the path cost
         '''
-        cost = 0
-        for i in range(len(path) - 1):
-            cost += self.get_link_cost(path[i], path[i+1])
-        return cost
+        index = self.index
+        return self.index_path_cost([index[node] for node in path])
 
     def get_optimal_paths(self, src, dst):
         '''
         Get the n-most optimal paths according to MAX_PATHS
         '''
+        if PATH_ALGORITHM == 'ksp':
+            return self.get_k_shortest_paths(src, dst, MAX_PATHS)
         paths = self.get_paths(src, dst)
         paths_count = len(paths) if len(
             paths) < MAX_PATHS else MAX_PATHS
         return sorted(paths, key=lambda x: self.get_path_cost(x))[0:(paths_count)]
 
+    def get_paths_with_costs(self, src, dst):
+        paths = self.get_optimal_paths(src, dst)
+        return paths, [self.get_path_cost(path) for path in paths]
+
+    def get_distances_to(self, dst):
+        '''
+        Get the cost of the cheapest path from every switch to dst, using
+        Dijkstra on the reversed links
+        '''
+        if dst not in self.index:
+            return {dst: 0}
+        indptr = self.indptr
+        indices = self.indices
+        reverse = self.reverse
+        connected = self.connected
+        edge_cost = self.cost
+        t = self.index[dst]
+        dist = {t: 0}
+        heap = [(0, t)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if cost > dist[node]:
+                continue
+            for e in range(indptr[node], indptr[node + 1]):
+                prev = indices[e]
+                if not connected[prev] or reverse[e] < 0:
+                    continue
+                prev_cost = cost + edge_cost[reverse[e]]
+                if prev not in dist or prev_cost < dist[prev]:
+                    dist[prev] = prev_cost
+                    heapq.heappush(heap, (prev_cost, prev))
+        nodes = self.nodes
+        return dict((nodes[i], cost) for i, cost in dist.items())
+
+
+def get_link_costs(capacity, utilization, far_capacity, delay):
+    '''
+    Get the cost of every link at once according to LINK_COST_MODE, from
+    lists with one entry per link. The bandwidth cost is REFERENCE_BW /
+    min(residual bandwidth, capacity of the far end), delays are in ms
+    '''
+    if LINK_COST_MODE == 'delay':
+        return [max(d, 0.001) for d in delay]
+    if numpy is None:
+        costs = [REFERENCE_BW / min(max(c - u, c * MIN_RESIDUAL_SHARE, 1), f)
+                 for c, u, f in zip(capacity, utilization, far_capacity)]
+        if LINK_COST_MODE == 'weighted':
+            costs = [cost + DELAY_COST_PER_MS * d for cost, d in zip(costs, delay)]
+        return costs
+    capacity = numpy.asarray(capacity, dtype=float)
+    residual = numpy.maximum(numpy.maximum(capacity - numpy.asarray(utilization, dtype=float),
+                                           capacity * MIN_RESIDUAL_SHARE), 1)
+    costs = REFERENCE_BW / numpy.minimum(residual, numpy.asarray(far_capacity, dtype=float))
+    if LINK_COST_MODE == 'weighted':
+        costs += DELAY_COST_PER_MS * numpy.asarray(delay, dtype=float)
+    return costs.tolist()
+
+
+class GroupIdAllocator(object):
+    '''
+    Hands out compact group ids for one datapath and reuses released ones
+    '''
+
+    def __init__(self):
+        self.next_id = 1
+        self.released = deque()
+
+    def allocate(self):
+        if self.released and time.time() - self.released[0][0] >= GROUP_ID_REUSE_DELAY:
+            return self.released.popleft()[1]
+        group_id = self.next_id
+        self.next_id += 1
+        return group_id
+
+    def release(self, group_id):
+        self.released.append((time.time(), group_id))
+
+    def reserve(self, group_ids):
+        '''
+        Never hand out group ids that are in use already, e.g. found on the
+        switch after a restart
+        '''
+        group_ids = set(group_ids)
+        if group_ids:
+            self.next_id = max(self.next_id, max(group_ids) + 1)
+        self.released = deque(r for r in self.released if r[1] not in group_ids)
+
+
+class MessageBatch(object):
+    '''
+    Collects the OpenFlow messages of one path installation per datapath,
+    so that every switch receives them in a single write
+    '''
+
+    def __init__(self):
+        self.messages = OrderedDict()
+
+    def add(self, datapath, msg):
+        if datapath.id not in self.messages:
+            self.messages[datapath.id] = (datapath, [])
+        self.messages[datapath.id][1].append(msg)
+
+
+class Metrics(object):
+    '''
+    Counters, gauges and histograms of the controller, rendered in the
+    Prometheus text format. Recording is a dict update, plus a bisect
+    for histograms, so it is cheap enough for the packet-in path
+    '''
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        self.counters[name, labels] += value
+
+    def set(self, name, labels, value):
+        self.gauges[name, labels] = value
+
+    def remove(self, name, labels):
+        self.gauges.pop((name, labels), None)
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+            name = None
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    name = metric
+                    lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for name, (counts, total) in sorted(self.histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum {total}')
+            lines.append(f'{name}_count {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class EventRecorder(object):
+    '''
+    Appends the events the controller handles to a binary log. A record is
+    a header (time, kind, dpid, payload length) followed by the payload:
+    the OpenFlow message as received from the switch, or the ports of a
+    link event. Barrier replies are left out, a replay answers the
+    barriers of its own messages. The xid of a resync request is recorded
+    too, so a replay can map the recorded replies to its own request
+    '''
+
+    MAGIC = b'RYUMPEV1'
+    HEADER = struct.Struct('!dBQI')
+    LINK = struct.Struct('!IQI')
+    XID = struct.Struct('!I')
+    SWITCH_ENTER, SWITCH_LEAVE, LINK_ADD, LINK_DELETE, OPENFLOW, RESYNC = range(1, 7)
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+        self.last_flush = time.time()
+        self.records = 0
+
+    def record(self, kind, dpid, payload=b''):
+        now = time.time()
+        self.file.write(self.HEADER.pack(now, kind, dpid, len(payload)))
+        self.file.write(payload)
+        self.records += 1
+        if now - self.last_flush >= self.FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+
+    def record_event(self, ev):
+        if isinstance(ev, event.EventSwitchEnter):
+            self.record(self.SWITCH_ENTER, ev.switch.dp.id)
+        elif isinstance(ev, event.EventSwitchLeave):
+            self.record(self.SWITCH_LEAVE, ev.switch.dp.id)
+        elif isinstance(ev, (event.EventLinkAdd, event.EventLinkDelete)):
+            kind = self.LINK_ADD if isinstance(ev, event.EventLinkAdd) else self.LINK_DELETE
+            src = ev.link.src
+            dst = ev.link.dst
+            self.record(kind, src.dpid, self.LINK.pack(src.port_no, dst.dpid, dst.port_no))
+        elif getattr(ev.msg, 'buf', None) is not None:
+            self.record(self.OPENFLOW, ev.msg.datapath.id, bytes(ev.msg.buf))
+
+    @classmethod
+    def read(cls, path):
+        '''
+        Yield the records of a log as (time, kind, dpid, payload)
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is no event log")
+            while True:
+                header = f.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:
+                    return
+                timestamp, kind, dpid, length = cls.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    # the controller stopped in the middle of a record
+                    return
+                yield timestamp, kind, dpid, payload
+
+
+class StatsWriter(object):
+    '''
+    Appends statistics samples to a columnar file. The rows of a table are
+    buffered and written as a block: the lengths of header and body, a JSON
+    header with the table, the number of rows and the column types, then
+    the body with every column in one piece
+    '''
+
+    MAGIC = b'RYUMPST1'
+    LENGTHS = struct.Struct('!II')
+    TABLES = {
+        'flow': (('time', 'd'), ('dpid', 'Q'), ('table_id', 'B'), ('priority', 'H'),
+                 ('cookie', 'Q'), ('match', 's'), ('duration', 'd'),
+                 ('packet_count', 'Q'), ('byte_count', 'Q')),
+        # one row per bucket and one with bucket -1 for the whole group
+        'group': (('time', 'd'), ('dpid', 'Q'), ('group_id', 'I'), ('bucket', 'i'),
+                  ('duration', 'd'), ('packet_count', 'Q'), ('byte_count', 'Q')),
+        'port': (('time', 'd'), ('dpid', 'Q'), ('port_no', 'I'), ('duration', 'd'),
+                 ('rx_packets', 'Q'), ('tx_packets', 'Q'), ('rx_bytes', 'Q'),
+                 ('tx_bytes', 'Q'), ('rx_dropped', 'Q'), ('tx_dropped', 'Q'),
+                 ('rx_errors', 'Q'), ('tx_errors', 'Q')),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+            self.file.flush()
+        self.rows = defaultdict(list)
+
+    def add(self, table, row):
+        self.rows[table].append(row)
+
+    def take(self):
+        '''
+        Get the buffered rows and start new buffers, so the rows can be
+        written while replies keep arriving
+        '''
+        rows = self.rows
+        self.rows = defaultdict(list)
+        return rows
+
+    def write(self, rows):
+        for table, values in rows.items():
+            columns = self.TABLES[table]
+            header = json.dumps({'table': table, 'rows': len(values),
+                                 'columns': columns}).encode()
+            body = []
+            for index, (name, kind) in enumerate(columns):
+                column = [row[index] for row in values]
+                if kind == 's':
+                    column = [value.encode() for value in column]
+                    body.append(struct.pack(f'!{len(column)}I', *map(len, column)))
+                    body.extend(column)
+                else:
+                    body.append(struct.pack(f'!{len(column)}{kind}', *column))
+            body = b''.join(body)
+            self.file.write(self.LENGTHS.pack(len(header), len(body)) + header + body)
+        self.file.flush()
+
+    @classmethod
+    def read(cls, path):
+        '''
+        Read a statistics file into a dict table -> column name -> list
+        '''
+        tables = {}
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is no statistics file")
+            while True:
+                lengths = f.read(cls.LENGTHS.size)
+                if len(lengths) < cls.LENGTHS.size:
+                    return tables
+                header_length, body_length = cls.LENGTHS.unpack(lengths)
+                header = f.read(header_length)
+                body = f.read(body_length)
+                if len(header) < header_length or len(body) < body_length:
+                    # the controller stopped in the middle of a block
+                    return tables
+                header = json.loads(header)
+                count = header['rows']
+                table = tables.setdefault(
+                    header['table'], dict((name, []) for name, kind in header['columns']))
+                offset = 0
+                for name, kind in header['columns']:
+                    if kind == 's':
+                        sizes = struct.unpack_from(f'!{count}I', body, offset)
+                        offset += 4 * count
+                        for size in sizes:
+                            table[name].append(body[offset:offset + size].decode())
+                            offset += size
+                    else:
+                        table[name].extend(struct.unpack_from(f'!{count}{kind}', body, offset))
+                        offset += struct.calcsize(f'!{count}{kind}')
+
+
+class ProjectController(app_manager.RyuApp):
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'wsgi': WSGIApplication}
+
+    def __init__(self, *args, **kwargs):
+        super(ProjectController, self).__init__(*args, **kwargs)
+        wsgi = kwargs['wsgi']
+        wsgi.register(MultipathRestController, {multipath_instance_name: self})
+        self.metrics = Metrics()
+        self.mac_to_port = {}
+        self.topology_api_app = self
+        self.datapath_list = {}
+        self.arp_table = {}
+        self.switches = []
+        self.hosts = {}
+        self.multipath_group_ids = {}
+        self.group_allocators = defaultdict(GroupIdAllocator)
+        self.group_refs = defaultdict(set)
+        self.flows = defaultdict(dict)
+        self.shadow_flows = defaultdict(dict)
+        self.shadow_groups = {}
+        # set while the REST API reinstalls rules explicitly, the switch may
+        # have lost them without telling the controller
+        self.bypass_shadow = False
+        self.qos_rules = defaultdict(set)
+        # the classifier table precedes the forwarding table
+        self.forwarding_table = 1 if QOS_ENABLED else 0
+        self.switch_ports = {}
+        self.flood_tree = defaultdict(set)
+        # parent, children, depth and root of every switch in the tree, and
+        # the members of every tree by its root
+        self.flood_parents = {}
+        self.flood_children = defaultdict(set)
+        self.flood_depths = {}
+        self.flood_roots = {}
+        self.flood_members = {}
+        self.flood_rules = defaultdict(dict)
+        # flood ports and tree ports of every switch when its rules were written
+        self.flood_sets = {}
+        self.packet_in_counts = defaultdict(int)
+        self.packet_in_total = 0
+        self.adjacency = defaultdict(dict)
+        self.bandwidths = defaultdict(lambda: defaultdict(lambda: DEFAULT_BW))
+        self.path_cache = PathCache(PATH_CACHE_SIZE)
+        self.topology = None
+        self.path_jobs = {}
+        self.path_queue = hub.Queue()
+        self.path_workers = [hub.spawn(self._path_worker) for i in range(PATH_WORKERS)]
+        self.topology_version = 0
+        self.install_requests = {}
+        self.last_topology_change = time.time()
+        self.proactive_pairs = set()
+        self.proactive_version = None
+        self.pending_installs = {}
+        self.barrier_xids = {}
+        self.install_latencies = deque(maxlen=1000)
+        self.next_install_id = 0
+        self.port_tx_bytes = {}
+        self.port_utilization = defaultdict(dict)
+        self.cost_residuals = {}
+        self.echo_rtts = {}
+        self.link_delays = {}
+        self.cost_delays = {}
+        self.installs = {}
+        self.link_installs = defaultdict(set)
+        self.select_groups = {}
+        self.group_bucket_bytes = {}
+        self.group_bucket_rates = {}
+        self.flow_bytes = {}
+        self.split_pairs = {}
+        self.elephants = {}
+        self.restored_adjacency = defaultdict(dict)
+        self.restored_links = {}
+        self.unverified_installs = set()
+        self.resyncs = {}
+        self.resync_xids = set()
+        self.resynced = set()
+        self.snapshot_text = None
+        self.recorder = EventRecorder(EVENT_LOG_FILE) if EVENT_LOG_FILE else None
+        self.stats_xids = {}
+        if STATS_INTERVAL:
+            self.stats_writer = StatsWriter(time.strftime(STATS_FILE))
+            self.stats_thread = hub.spawn(self._stats_loop)
+        if SNAPSHOT_FILE:
+            self.load_snapshot()
+            self.snapshot_thread = hub.spawn(self._snapshot_loop)
+        if PORT_STATS_INTERVAL:
+            self.port_stats_thread = hub.spawn(self._port_stats_loop)
+            if REBALANCE_INTERVAL:
+                self.rebalance_thread = hub.spawn(self._rebalance_loop)
+        if DELAY_PROBE_INTERVAL and LINK_COST_MODE != 'bandwidth':
+            self.delay_probe_thread = hub.spawn(self._delay_probe_loop)
+        if ELEPHANT_INTERVAL and GROUP_MODE == 'select' and FORWARDING_MODE == 'pair':
+            self.elephant_thread = hub.spawn(self._elephant_loop)
+        if PROACTIVE_MODE:
+            self.proactive_thread = hub.spawn(self._proactive_loop)
+
+    def topology_changed(self, entered=None, added=(), removed=()):
+        '''
+        Remember when the topology changed last, to detect convergence, and
+        adapt the flood spanning tree to the switch that entered and the
+        switch links (dpid1, dpid2) that were added or removed. Otherwise a
+        switch left and the tree is rebuilt
+        '''
+        self.topology_version += 1
+        self.last_topology_change = time.time()
+        if entered is not None or added or removed:
+            self.update_flood_tree(entered, added, removed)
+        else:
+            self.compute_flood_tree()
+
+    def compute_flood_tree(self, changed=None):
+        '''
+        Compute a spanning tree of every connected part of the switch graph
+        with a BFS from its smallest dpid and update the broadcast rules of
+        the switches whose tree ports changed and of the switches in changed,
+        or of all switches if changed is None
+        '''
+        previous = self.flood_tree
+        self.flood_parents = {}
+        self.flood_children = defaultdict(set)
+        self.flood_depths = {}
+        self.flood_roots = {}
+        self.flood_members = {}
+        for root in sorted(self.datapath_list):
+            if root in self.flood_roots:
+                continue
+            self.flood_parents[root] = None
+            self.flood_depths[root] = 0
+            self.flood_roots[root] = root
+            self.flood_members[root] = {root}
+            queue = deque([root])
+            while queue:
+                node = queue.popleft()
+                for next in sorted(self.adjacency[node]):
+                    if next in self.flood_roots or next not in self.datapath_list:
+                        continue
+                    self.flood_parents[next] = node
+                    self.flood_children[node].add(next)
+                    self.flood_depths[next] = self.flood_depths[node] + 1
+                    self.flood_roots[next] = root
+                    self.flood_members[root].add(next)
+                    queue.append(next)
+        self.flood_tree = defaultdict(set)
+        for dpid in self.datapath_list:
+            self.set_flood_ports(dpid)
+        if changed is None:
+            changed = set(self.datapath_list)
+        else:
+            changed = set(changed) | set(dpid for dpid in self.datapath_list
+                                         if self.flood_tree[dpid] != previous.get(dpid, set()))
+        self.update_flood_switches(changed)
+
+    def update_flood_tree(self, entered, added, removed):
+        '''
+        Adapt the flood spanning tree to an entered switch, which starts a
+        tree of its own with its links added, and to added and removed switch
+        links. A link joining two trees becomes a tree link, and so does a
+        link that brings a switch closer to the root of its tree, like the
+        BFS would. Other links only change the rules of their own switches.
+        Removing a tree link splits the tree, which is then computed again
+        '''
+        changed = set()
+        if entered is not None:
+            changed.add(entered)
+            self.flood_parents[entered] = None
+            self.flood_depths[entered] = 0
+            self.flood_roots[entered] = entered
+            self.flood_members[entered] = {entered}
+            added = list(added) + [(entered, neighbor) for neighbor in self.adjacency[entered]]
+        for dpid1, dpid2 in list(added) + list(removed):
+            changed.update((dpid1, dpid2))
+        for dpid1, dpid2 in removed:
+            if self.flood_parents.get(dpid1) == dpid2 or self.flood_parents.get(dpid2) == dpid1:
+                self.compute_flood_tree(changed)
+                return
+        for dpid1, dpid2 in added:
+            if dpid1 not in self.flood_roots or dpid2 not in self.flood_roots \
+                    or dpid2 not in self.adjacency[dpid1] or dpid1 not in self.adjacency[dpid2]:
+                continue
+            if self.flood_roots[dpid1] != self.flood_roots[dpid2]:
+                self.join_flood_trees(dpid1, dpid2)
+            elif self.flood_depths[dpid1] + 1 < self.flood_depths[dpid2]:
+                changed.add(self.move_flood_subtree(dpid2, dpid1))
+            elif self.flood_depths[dpid2] + 1 < self.flood_depths[dpid1]:
+                changed.add(self.move_flood_subtree(dpid1, dpid2))
+        for dpid in changed:
+            if dpid in self.flood_roots:
+                self.set_flood_ports(dpid)
+        self.update_flood_switches(changed)
+
+    def join_flood_trees(self, dpid1, dpid2):
+        '''
+        Hang the smaller of the trees of dpid1 and dpid2 below the other one,
+        over the link between them
+        '''
+        root1 = self.flood_roots[dpid1]
+        root2 = self.flood_roots[dpid2]
+        if len(self.flood_members[root1]) < len(self.flood_members[root2]):
+            dpid1, dpid2, root1, root2 = dpid2, dpid1, root2, root1
+        # make dpid2 the root of its tree, the tree ports stay the same
+        node, child = dpid2, None
+        while node is not None:
+            parent = self.flood_parents[node]
+            self.flood_parents[node] = child
+            if parent is not None:
+                self.flood_children[parent].discard(node)
+                self.flood_children[node].add(parent)
+            node, child = parent, node
+        self.flood_members[root1] |= self.flood_members.pop(root2)
+        self.attach_flood_subtree(dpid2, dpid1)
+
+    def move_flood_subtree(self, dpid, parent):
+        '''
+        Hang the subtree of dpid below parent and return its former parent
+        '''
+        previous = self.flood_parents[dpid]
+        self.flood_children[previous].discard(dpid)
+        self.attach_flood_subtree(dpid, parent)
+        return previous
+
+    def attach_flood_subtree(self, dpid, parent):
+        self.flood_parents[dpid] = parent
+        self.flood_children[parent].add(dpid)
+        root = self.flood_roots[parent]
+        queue = deque([dpid])
+        while queue:
+            node = queue.popleft()
+            self.flood_depths[node] = self.flood_depths[self.flood_parents[node]] + 1
+            self.flood_roots[node] = root
+            queue.extend(self.flood_children[node])
+
+    def set_flood_ports(self, dpid):
+        neighbors = set(self.flood_children[dpid])
+        if self.flood_parents.get(dpid) is not None:
+            neighbors.add(self.flood_parents[dpid])
+        self.flood_tree[dpid] = set(self.adjacency[dpid][neighbor] for neighbor in neighbors)
+
+    def update_flood_switches(self, dpids):
+        if FLOOD_MODE == 'tree':
+            for dpid in dpids:
+                if dpid in self.datapath_list:
+                    self.update_flood_rules(dpid)
+
+    def get_flood_ports(self, dpid, in_port):
+        '''
+        Get the ports a packet from in_port is flooded to: the spanning tree
+        ports and all ports that do not lead to another switch. A packet from
+        a switch link outside the tree is not flooded at all
+        '''
+        switch_links = set(self.adjacency[dpid].values())
+        if in_port in switch_links and in_port not in self.flood_tree[dpid]:
+            return []
+        ports = (self.switch_ports[dpid] - switch_links) | self.flood_tree[dpid]
+        return sorted(ports - {in_port})
+
+    def update_flood_rules(self, dpid):
+        '''
+        Install a broadcast rule per switch link, flooding along the tree or
+        dropping packets that arrive outside of it. Broadcasts from hosts
+        still reach the controller, which floods them with a PacketOut
+        '''
+        dp = self.datapath_list[dpid]
+        if dpid not in self.switch_ports:
+            return
+        ofp_parser = dp.ofproto_parser
+        rules = self.flood_rules[dpid]
+        switch_links = set(self.adjacency[dpid].values())
+        tree = set(self.flood_tree[dpid])
+        flood = (self.switch_ports[dpid] - switch_links) | tree
+        previous = self.flood_sets.get(dpid)
+        if previous is not None and previous[0] == flood:
+            # the rules of the other tree ports stay the same
+            ports = (set(rules) ^ switch_links) | (tree ^ previous[1])
+        else:
+            ports = set(rules) | switch_links
+        self.flood_sets[dpid] = (flood, tree)
+        for port in sorted(ports):
+            out_ports = None
+            if port in tree:
+                out_ports = tuple(sorted(flood - {port}))
+            elif port in switch_links:
+                out_ports = ()
+            if rules.get(port) == out_ports:
+                continue
+            match = ofp_parser.OFPMatch(in_port=port, eth_dst=mac.BROADCAST_STR)
+            if port in rules:
+                self.delete_flow(dp, FLOOD_PRIORITY, match)
+                del rules[port]
+            if out_ports is not None:
+                actions = [ofp_parser.OFPActionOutput(p) for p in out_ports]
+                self.add_flow(dp, FLOOD_PRIORITY, match, actions)
+                rules[port] = out_ports
+
+    def get_port_capacity(self, dpid, port):
+        '''
+        Get the capacity of a port in kbit/s
+        '''
+        if LINK_CAPACITY is not None:
+            return LINK_CAPACITY
+        return self.bandwidths[dpid][port]
+
+    def get_residual_bw(self, dpid, port):
+        '''
+        Get the capacity of a port minus its measured transmit rate
+        '''
+        capacity = self.get_port_capacity(dpid, port)
+        residual = capacity - self.port_utilization[dpid].get(port, 0)
+        return max(residual, capacity * MIN_RESIDUAL_SHARE, 1)
+
+    # the path computations live on TopologySnapshot, these are kept for
+    # callers of the former dict-based API
+    def get_link_cost(self, s1, s2):
+        return self.get_topology().get_link_cost(s1, s2)
+
+    def get_paths(self, src, dst):
+        return self.get_topology().get_paths(src, dst)
+
+    def get_path_cost(self, path):
+        return self.get_topology().get_path_cost(path)
+
+    def get_optimal_paths(self, src, dst):
+        return self.get_topology().get_optimal_paths(src, dst)
+
+    def get_cached_paths(self, src, dst):
+        '''
+        Get the optimal paths and their costs, served from the path cache
+        as long as the topology has not changed
+        '''
+        cached = self.path_cache.get(src, dst)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        paths, pw = self.get_topology().get_paths_with_costs(src, dst)
+        self.metrics.observe('controller_path_compute_seconds',
+                             time.perf_counter() - start)
+        self.path_cache.put(src, dst, paths, pw)
+        return paths, pw
+
+    def get_topology(self):
+        '''
+        Get the snapshot of the current topology, copied again only after
+        the topology or the link costs changed
+        '''
+        version = (self.topology_version, self.path_cache.version)
+        if self.topology is None or self.topology.version != version:
+            structure = None
+            if self.topology is not None and self.topology.version[0] == self.topology_version:
+                # only the link costs changed, the graph arrays are shared
+                structure = self.topology.get_structure()
+            topology = TopologySnapshot(version, self.adjacency,
+                                        set(self.datapath_list), structure)
+            links = topology.get_out_links()
+            topology.cost = get_link_costs(
+                [self.get_port_capacity(s1, port1) for s1, port1, s2, port2 in links],
+                [self.port_utilization[s1].get(port1, 0) for s1, port1, s2, port2 in links],
+                [self.get_port_capacity(s2, port2) for s1, port1, s2, port2 in links],
+                [self.link_delays.get((s1, s2), DEFAULT_LINK_DELAY)
+                 for s1, port1, s2, port2 in links])
+            self.topology = topology
+        return self.topology
+
+    def defer_paths(self, pairs, callback):
+        '''
+        Queue the (src, dst) switch pairs missing in the path cache for the
+        path workers and call callback on the event loop once all of them
+        are computed. Returns False if there is nothing to wait for
+        '''
+        if not PATH_WORKERS or FORWARDING_MODE != 'pair':
+            return False
+        missing = set(pair for pair in pairs
+                      if pair[0] != pair[1] and not self.path_cache.contains(*pair))
+        if not missing:
+            return False
+        waiter = {'pending': missing, 'callback': callback}
+        for pair in missing:
+            job = self.path_jobs.get(pair)
+            if job is None:
+                # a pair already queued or running is not computed twice
+                job = self.path_jobs[pair] = {
+                    'pair': pair,
+                    'topology': self.get_topology(),
+                    'queued': time.perf_counter(),
+                    'waiters': [],
+                }
+                self.path_cache.misses += 1
+                self.path_queue.put(job)
+            job['waiters'].append(waiter)
+        return True
+
+    def _path_worker(self):
+        while True:
+            job = self.path_queue.get()
+            start = time.perf_counter()
+            self.metrics.observe('controller_path_queue_wait_seconds', start - job['queued'])
+            try:
+                result = tpool.execute(job['topology'].get_paths_with_costs, *job['pair'])
+            except Exception as e:
+                print ("Path computation for", job['pair'], "failed:", e)
+                result = None
+            self.metrics.observe('controller_path_compute_seconds',
+                                 time.perf_counter() - start)
+            self.finish_path_job(job, result)
+
+    def finish_path_job(self, job, result):
+        '''
+        Apply the result of a path worker on the event loop. Paths computed
+        on an outdated topology are dropped, their waiters compute inline
+        '''
+        del self.path_jobs[job['pair']]
+        if (result is not None and job['topology'].version
+                == (self.topology_version, self.path_cache.version)):
+            self.path_cache.put(job['pair'][0], job['pair'][1], *result)
+        for waiter in job['waiters']:
+            waiter['pending'].discard(job['pair'])
+            if waiter['pending']:
+                continue
+            try:
+                waiter['callback']()
+            except Exception as e:
+                print ("Deferred packet-in for", job['pair'], "failed:", e)
+
     def add_ports_to_paths(self, paths, first_port, last_port):
         '''
         Add the ports that connects the switches for all paths
@@ -116,28 +1320,296 @@ class ProjectController(app_manager.RyuApp):
             paths_p.append(p)
         return paths_p
 
-    def generate_openflow_gid(self):
+    def generate_openflow_gid(self, dpid):
+        '''
+        Returns an unused OpenFlow group id of the datapath
+        '''
+        return self.group_allocators[dpid].allocate()
+
+    def track_flow(self, dpid, priority, match, actions, batch=None):
+        '''
+        Remember an installed flow and the group it points to, so groups
+        are deleted as soon as no flow refers to them anymore
+        '''
+        key = (priority, tuple(sorted(match.items())))
+        group_id = None
+        for action in actions:
+            group_id = getattr(action, 'group_id', group_id)
+        old_group_id = self.flows[dpid].get(key)
+        self.flows[dpid][key] = group_id
+        if group_id is not None:
+            self.group_refs[dpid, group_id].add(key)
+        if old_group_id is not None and old_group_id != group_id:
+            self.release_group_ref(dpid, old_group_id, key, batch)
+
+    def untrack_flow(self, dpid, priority, match, batch=None):
+        key = (priority, tuple(sorted(match.items())))
+        self.shadow_flows[dpid].pop(key, None)
+        if key not in self.flows[dpid]:
+            return
+        group_id = self.flows[dpid].pop(key)
+        if group_id is not None:
+            self.release_group_ref(dpid, group_id, key, batch)
+
+    def release_group_ref(self, dpid, group_id, key, batch=None):
+        refs = self.group_refs.get((dpid, group_id))
+        if refs is None:
+            return
+        refs.discard(key)
+        if refs:
+            return
+        # orphaned group
+        del self.group_refs[dpid, group_id]
+        self.forget_select_group(dpid, group_id)
+        for group_key, value in list(self.multipath_group_ids.items()):
+            if group_key[0] == dpid and value == group_id:
+                del self.multipath_group_ids[group_key]
+        self.group_allocators[dpid].release(group_id)
+        dp = self.datapath_list.get(dpid)
+        if dp is None:
+            return
+        self.shadow_groups.pop((dpid, group_id), None)
+        req = dp.ofproto_parser.OFPGroupMod(
+            dp, dp.ofproto.OFPGC_DELETE, dp.ofproto.OFPGT_SELECT, group_id)
+        if batch is not None:
+            batch.add(dp, req)
+        else:
+            self.send_msg(dp, req)
+
+    def add_group(self, datapath, command, group_type, group_id, buckets, batch=None):
+        '''
+        Add or modify a group, unless the switch holds it with the same
+        buckets already
+        '''
+        signature = (group_type, get_buckets_signature(buckets))
+        if (not self.bypass_shadow
+                and self.shadow_groups.get((datapath.id, group_id)) == signature):
+            self.metrics.inc('controller_suppressed_messages_total', (('type', 'group_mod'),))
+            return
+        self.shadow_groups[datapath.id, group_id] = signature
+        req = datapath.ofproto_parser.OFPGroupMod(
+            datapath, command, group_type, group_id, buckets)
+        if batch is not None:
+            batch.add(datapath, req)
+        else:
+            self.send_msg(datapath, req)
+
+    def install_paths(self, src, first_port, dst, last_port, ip_src, ip_dst,
+                      callback=None, batch=None):
+        '''
+        Install the paths from ip_src to ip_dst and return the out port on
+        the src switch. If batch is given the messages are only added to it
+        and the caller sends the batch
+        '''
+        if FORWARDING_MODE == 'destination':
+            return self.install_destination_path(src, dst, last_port, ip_dst,
+                                                 callback, batch)
+        key = (src, dst, ip_src, ip_dst)
+        request = self.install_requests.get(key)
+        if (batch is None and not self.bypass_shadow
+                and request is not None and key in self.installs
+                and time.time() - request['time'] < INSTALL_COALESCE_WINDOW
+                and request['version'] == (self.topology_version, self.path_cache.version)
+                and request['ports'] == (first_port, last_port)):
+            self.metrics.inc('controller_collapsed_installs_total')
+            self.join_install(request['install_id'], callback)
+            return request['out_port']
+
+        computation_start = time.time()
+        start = time.perf_counter()
+        paths, pw = self.get_cached_paths(src, dst)
+        if not paths:
+            print (f"No path for {ip_src} -> {ip_dst} from {src} to {dst}")
+            self.forget_install((src, dst, ip_src, ip_dst))
+            return None
+        for path, cost in zip(paths, pw):
+            print (path, "cost = ", cost)
+        paths_with_ports = self.add_ports_to_paths(paths, first_port, last_port)
+        own_batch = batch is None
+        if own_batch:
+            batch = MessageBatch()
+        if GROUP_MODE == 'fast_failover':
+            out_ports, backup_rules = self.add_failover_flows(
+                batch, src, dst, paths[0], first_port, last_port, ip_src, ip_dst)
+        else:
+            out_ports = self.add_multipath_flows(
+                batch, src, dst, paths, paths_with_ports, pw, ip_src, ip_dst)
+            backup_rules = {}
+
+        self.unsplit_pair(key, batch)
+        self.remove_stale_flows(key, set(out_ports), backup_rules, batch)
+        self.record_install(key, first_port, last_port, out_ports, backup_rules)
+        if own_batch:
+            # only installs with their own batch can be joined, the batch of a
+            # caller may not be sent yet
+            self.install_requests[key] = {
+                'time': time.time(),
+                'version': (self.topology_version, self.path_cache.version),
+                'ports': (first_port, last_port),
+                'out_port': paths_with_ports[0][src][1],
+                'install_id': self.send_batch(batch, src, f"{ip_src} -> {ip_dst}", callback),
+            }
+        self.metrics.observe('controller_install_seconds', time.perf_counter() - start)
+        self.metrics.set('controller_pair_paths',
+                         (('ip_src', ip_src), ('ip_dst', ip_dst)), len(paths))
+        print ("Path installation finished in ", time.time() - computation_start,
+               "(path cache hits:", self.path_cache.hits,
+               "misses:", self.path_cache.misses, ")")
+        print(f"Installierte Route für {ip_src} -> {ip_dst}: {list(paths_with_ports[0].keys())}")
+        return paths_with_ports[0][src][1]
+
+    def install_destination_path(self, src, dst, last_port, ip_dst, callback=None,
+                                 batch=None):
+        '''
+        Make sure the destination tree of ip_dst is installed for the current
+        topology and return the out port on the src switch
+        '''
+        key = (None, dst, None, ip_dst)
+        install = self.installs.get(key)
+        rule = (32768, (('eth_type', 0x0800), ('ipv4_dst', ip_dst)))
+        if (install is None or install['version'] != self.topology_version
+                or install['last_port'] != last_port
+                # the switch lost the rule of the tree
+                or (src in install['out_ports'] and rule not in self.flows[src])):
+            self.install_destination_tree(dst, last_port, ip_dst, callback, batch)
+            install = self.installs.get(key)
+        elif callback is not None and batch is None:
+            callback()
+        if install is None or src not in install['out_ports']:
+            return None
+        return install['out_ports'][src][0]
+
+    def install_destination_tree(self, dst, last_port, ip_dst, callback=None,
+                                 batch=None):
+        '''
+        Install one rule for ip_dst on every switch that can reach dst. Each
+        switch forwards to the neighbors on its cheapest paths, using an
+        OFPGT_SELECT group if there is more than one. Next hops are always
+        strictly closer to dst, so the rules are loop free
+        '''
+        computation_start = time.time()
+        key = (None, dst, None, ip_dst)
+        start = time.perf_counter()
+        topology = self.get_topology()
+        dist = topology.get_distances_to(dst)
+        self.metrics.observe('controller_path_compute_seconds',
+                             time.perf_counter() - start)
+        out_ports = OrderedDict()
+        own_batch = batch is None
+        if own_batch:
+            batch = MessageBatch()
+        previous = self.installs.get(key)
+        if previous is not None and previous['last_port'] != last_port:
+            previous = None
+        rule = (32768, (('eth_type', 0x0800), ('ipv4_dst', ip_dst)))
+
+        # fill the batch from the destination outwards
+        for node in sorted(dist, key=lambda n: dist[n]):
+            if node == dst:
+                out_ports[node] = [last_port]
+            else:
+                out_ports[node] = [
+                    self.adjacency[node][next] for next in sorted(self.adjacency[node])
+                    if next in dist and dist[next] < dist[node]
+                    and dist[next] + topology.get_link_cost(node, next)
+                    <= dist[node] * (1 + ECMP_TOLERANCE)]
+
+            ports = out_ports[node]
+            if (previous is not None and not self.bypass_shadow
+                    and previous['out_ports'].get(node) == ports
+                    and rule in self.flows[node]):
+                # same next hops as before, the switch is neither written nor
+                # waited for
+                continue
+
+            dp = self.datapath_list[node]
+            ofp = dp.ofproto
+            ofp_parser = dp.ofproto_parser
+            match_ip = ofp_parser.OFPMatch(eth_type=0x0800, ipv4_dst=ip_dst)
+            match_arp = ofp_parser.OFPMatch(eth_type=0x0806, arp_tpa=ip_dst)
+
+            if len(ports) > 1:
+                group_new = False
+                if (node, ip_dst) not in self.multipath_group_ids:
+                    group_new = True
+                    self.multipath_group_ids[
+                        node, ip_dst] = self.generate_openflow_gid(node)
+                group_id = self.multipath_group_ids[node, ip_dst]
+                buckets = [
+                    ofp_parser.OFPBucket(
+                        weight=1,
+                        watch_port=port,
+                        watch_group=ofp.OFPG_ANY,
+                        actions=[ofp_parser.OFPActionOutput(port)]
+                    )
+                    for port in ports
+                ]
+                command = ofp.OFPGC_ADD if group_new else ofp.OFPGC_MODIFY
+                self.add_group(dp, command, ofp.OFPGT_SELECT, group_id, buckets, batch)
+                self.register_select_group(
+                    node, group_id, [(port, 1, [(node, port)]) for port in ports])
+                actions = [ofp_parser.OFPActionGroup(group_id)]
+            else:
+                actions = [ofp_parser.OFPActionOutput(ports[0])]
+
+            self.add_path_flow(dp, 32768, match_ip, actions, batch)
+            self.add_path_flow(dp, 1, match_arp, actions, batch)
+
+        self.remove_stale_flows(key, set(out_ports), {}, batch)
+        self.record_install(key, None, last_port, out_ports, {})
+        if own_batch:
+            self.send_batch(batch, None, f"tree to {ip_dst}", callback)
+        self.metrics.observe('controller_install_seconds', time.perf_counter() - start)
+        self.metrics.set('controller_tree_switches', (('ip_dst', ip_dst),),
+                         len(out_ports))
+        occupancy = self.get_table_occupancy()
+        print ("Destination tree for", ip_dst, "on", len(out_ports),
+               "switches installed in", time.time() - computation_start)
+        print ("Flow table occupancy:", occupancy)
+
+    def get_metrics(self):
         '''
-        Returns a random OpenFlow group id
+        Get all metrics in the Prometheus text format. Values the controller
+        keeps anyway are copied into the gauges only when scraped
         '''
-        n = random.randint(0, 2**32)
-        while n in self.group_ids:
-            n = random.randint(0, 2**32)
-        return n
+        metrics = self.metrics
+        for dpid, count in self.get_table_occupancy().items():
+            metrics.set('controller_flows', (('dpid', dpid),), count)
+        # the path cache counts its hits and misses itself
+        metrics.counters['controller_path_cache_hits_total', ()] = self.path_cache.hits
+        metrics.counters['controller_path_cache_misses_total', ()] = self.path_cache.misses
+        metrics.set('controller_pending_installs', (), len(self.pending_installs))
+        metrics.set('controller_path_queue_depth', (), self.path_queue.qsize())
+        metrics.set('controller_path_jobs', (), len(self.path_jobs))
+        for key in [k for k in metrics.gauges if k[0] == 'controller_link_delay_seconds']:
+            del metrics.gauges[key]
+        for (s1, s2), delay in self.link_delays.items():
+            metrics.set('controller_link_delay_seconds', (('src', s1), ('dst', s2)), delay / 1000)
+        return metrics.render()
 
+    def get_table_occupancy(self):
+        '''
+        Get the number of flows the controller installed per datapath
+        '''
+        return dict((dpid, len(self.flows[dpid])) for dpid in sorted(self.datapath_list))
 
-    def install_paths(self, src, first_port, dst, last_port, ip_src, ip_dst):
-        computation_start = time.time()
-        paths = self.get_optimal_paths(src, dst)
-        pw = []
-        for path in paths:
-            pw.append(self.get_path_cost(path))
-            print (path, "cost = ", pw[len(pw) - 1])
+    def add_multipath_flows(self, batch, src, dst, paths, paths_with_ports, pw,
+                            ip_src, ip_dst):
+        '''
+        Add the flows of all paths to the batch, using an OFPGT_SELECT group
+        where the paths split up. Returns the out ports programmed per switch
+        '''
         sum_of_pw = sum(pw) * 1.0
-        paths_with_ports = self.add_ports_to_paths(paths, first_port, last_port)
+        programmed = {}
         switches_in_paths = set().union(*paths)
 
-        for node in switches_in_paths:
+        # fill the batch from the destination backwards
+        hops_to_src = {}
+        for path in paths:
+            for i, node in enumerate(path):
+                hops_to_src[node] = max(hops_to_src.get(node, 0), i)
+
+        for node in sorted(switches_in_paths, key=lambda n: -hops_to_src[n]):
 
             dp = self.datapath_list[node]
             ofp = dp.ofproto
@@ -145,6 +1617,7 @@ class ProjectController(app_manager.RyuApp):
 
             ports = defaultdict(list)
             actions = []
+            suffixes = {}
             i = 0
 
             for path in paths_with_ports:
@@ -153,9 +1626,14 @@ class ProjectController(app_manager.RyuApp):
                     out_port = path[node][1]
                     if (out_port, pw[i]) not in ports[in_port]:
                         ports[in_port].append((out_port, pw[i]))
+                    # links from node to dst, for rebalancing the group
+                    suffix = paths[i][paths[i].index(node):-1]
+                    suffixes.setdefault(out_port, [(n, path[n][1]) for n in suffix])
                 i += 1
 
-            for in_port in ports:
+            # the match has no in_port, so of several in_ports only the rule
+            # written last would stay on the switch
+            for in_port in list(ports)[-1:]:
 
                 match_ip = ofp_parser.OFPMatch(
                     eth_type=0x0800, 
@@ -169,6 +1647,7 @@ class ProjectController(app_manager.RyuApp):
                 )
 
                 out_ports = ports[in_port]
+                programmed[node] = [port for port, weight in out_ports]
                 # print out_ports 
 
                 if len(out_ports) > 1:
@@ -178,13 +1657,14 @@ class ProjectController(app_manager.RyuApp):
                     if (node, src, dst) not in self.multipath_group_ids:
                         group_new = True
                         self.multipath_group_ids[
-                            node, src, dst] = self.generate_openflow_gid()
+                            node, src, dst] = self.generate_openflow_gid(node)
                     group_id = self.multipath_group_ids[node, src, dst]
 
                     buckets = []
                     # print "node at ",node," out ports : ",out_ports
                     for port, weight in out_ports:
-                        bucket_weight = int(round((1 - weight/sum_of_pw) * 10))
+                        bucket_weight = max(1, int(round(
+                            (1 - weight/sum_of_pw) * BUCKET_WEIGHT_SCALE)))
                         bucket_action = [ofp_parser.OFPActionOutput(port)]
                         buckets.append(
                             ofp_parser.OFPBucket(
@@ -195,52 +1675,760 @@ class ProjectController(app_manager.RyuApp):
                             )
                         )
 
-                    if group_new:
-                        req = ofp_parser.OFPGroupMod(
-                            dp, ofp.OFPGC_ADD, ofp.OFPGT_SELECT, group_id,
-                            buckets
-                        )
-                        dp.send_msg(req)
-                    else:
-                        req = ofp_parser.OFPGroupMod(
-                            dp, ofp.OFPGC_MODIFY, ofp.OFPGT_SELECT,
-                            group_id, buckets)
-                        dp.send_msg(req)
+                    command = ofp.OFPGC_ADD if group_new else ofp.OFPGC_MODIFY
+                    self.add_group(dp, command, ofp.OFPGT_SELECT, group_id, buckets, batch)
+                    self.register_select_group(
+                        node, group_id, [(b.actions[0].port, b.weight,
+                                          suffixes[b.actions[0].port]) for b in buckets])
 
                     actions = [ofp_parser.OFPActionGroup(group_id)]
 
-                    self.add_flow(dp, 32768, match_ip, actions)
-                    self.add_flow(dp, 1, match_arp, actions)
+                    self.add_path_flow(dp, 32768, match_ip, actions, batch, node == src)
+                    self.add_path_flow(dp, 1, match_arp, actions, batch, node == src)
 
                 elif len(out_ports) == 1:
                     actions = [ofp_parser.OFPActionOutput(out_ports[0][0])]
 
-                    self.add_flow(dp, 32768, match_ip, actions)
-                    self.add_flow(dp, 1, match_arp, actions)
-        print ("Path installation finished in ", time.time() - computation_start)
-        print(f"Installierte Route für {ip_src} -> {ip_dst}: {list(paths_with_ports[0].keys())}")
-        return paths_with_ports[0][src][1]
+                    self.add_path_flow(dp, 32768, match_ip, actions, batch, node == src)
+                    self.add_path_flow(dp, 1, match_arp, actions, batch, node == src)
+
+        return programmed
+
+    def add_failover_flows(self, batch, src, dst, primary, first_port, last_port,
+                           ip_src, ip_dst):
+        '''
+        Add the flows of the primary path to the batch with an
+        OFPGT_FAST_FAILOVER group on every switch that has a backup next hop.
+        A backup path preferably avoids the protected link and all switches
+        upstream of it and is only followed until it rejoins the primary path.
+        Where no such path exists the backup turns back upstream, and the
+        switches on the way get rules matching the backup's in_port, so
+        forwarding stays loop free for any single link failure.
+        Returns the out ports per switch and the in_port rules per switch
+        '''
+        topology = self.get_topology()
+        out_ports = OrderedDict()
+        out_ports[dst] = [last_port]
+        backup_rules = defaultdict(dict)
+        # compute backups from the destination backwards, so where backup
+        # paths cross the one closest to the destination is kept
+        for i in range(len(primary) - 2, -1, -1):
+            node = primary[i]
+            out_ports[node] = [self.adjacency[node][primary[i + 1]]]
+            protected = {(node, primary[i + 1])}
+            backup = topology.get_shortest_path(node, dst, set(primary[:i]), protected)
+            crankback = backup is None
+            if crankback:
+                backup = topology.get_shortest_path(node, dst, (), protected)
+            if backup is None:
+                continue
+            backup = backup[1]
+            out_ports[node].append(self.adjacency[node][backup[1]])
+            for j in range(1, len(backup) - 1):
+                s1 = backup[j]
+                if s1 in primary and primary.index(s1) > i:
+                    break
+                out_port = self.adjacency[s1][backup[j + 1]]
+                if crankback:
+                    in_port = self.adjacency[s1][backup[j - 1]]
+                    backup_rules[s1].setdefault(in_port, out_port)
+                elif s1 not in out_ports:
+                    out_ports[s1] = [out_port]
+
+        in_ports = {}
+        for i in range(1, len(primary)):
+            in_ports[primary[i]] = self.adjacency[primary[i]][primary[i - 1]]
+
+        for node in list(out_ports) + [n for n in backup_rules if n not in out_ports]:
+            dp = self.datapath_list[node]
+            ofp = dp.ofproto
+            ofp_parser = dp.ofproto_parser
+
+            match_ip = ofp_parser.OFPMatch(
+                eth_type=0x0800,
+                ipv4_src=ip_src,
+                ipv4_dst=ip_dst
+            )
+            match_arp = ofp_parser.OFPMatch(
+                eth_type=0x0806,
+                arp_spa=ip_src,
+                arp_tpa=ip_dst
+            )
+
+            for in_port, out_port in backup_rules[node].items():
+                actions = [ofp_parser.OFPActionOutput(out_port)]
+                self.add_path_flow(dp, 32769, ofp_parser.OFPMatch(
+                    in_port=in_port, eth_type=0x0800, ipv4_src=ip_src,
+                    ipv4_dst=ip_dst), actions, batch)
+                self.add_path_flow(dp, 2, ofp_parser.OFPMatch(
+                    in_port=in_port, eth_type=0x0806, arp_spa=ip_src,
+                    arp_tpa=ip_dst), actions, batch)
+            if node not in out_ports:
+                continue
+
+            ports = out_ports[node]
+            if len(ports) > 1:
+                group_new = False
+                if (node, src, dst) not in self.multipath_group_ids:
+                    group_new = True
+                    self.multipath_group_ids[
+                        node, src, dst] = self.generate_openflow_gid(node)
+                group_id = self.multipath_group_ids[node, src, dst]
+
+                # the first live bucket is used, the primary port comes first.
+                # Sending back out of the in_port needs OFPP_IN_PORT
+                buckets = [
+                    ofp_parser.OFPBucket(
+                        watch_port=port,
+                        watch_group=ofp.OFPG_ANY,
+                        actions=[ofp_parser.OFPActionOutput(
+                            ofp.OFPP_IN_PORT if port == in_ports.get(node) else port)]
+                    )
+                    for port in ports
+                ]
+                command = ofp.OFPGC_ADD if group_new else ofp.OFPGC_MODIFY
+                self.add_group(dp, command, ofp.OFPGT_FF, group_id, buckets, batch)
+                actions = [ofp_parser.OFPActionGroup(group_id)]
+            else:
+                actions = [ofp_parser.OFPActionOutput(ports[0])]
+
+            self.add_path_flow(dp, 32768, match_ip, actions, batch, node == src)
+            self.add_path_flow(dp, 1, match_arp, actions, batch, node == src)
+
+        for node in backup_rules:
+            if node not in out_ports:
+                out_ports[node] = []
+            for out_port in backup_rules[node].values():
+                if out_port not in out_ports[node]:
+                    out_ports[node].append(out_port)
+        return out_ports, backup_rules
+
+    def record_install(self, key, first_port, last_port, out_ports, backup_rules):
+        '''
+        Remember an installed pair and index it by the (dpid, out_port) of
+        every hop, so link failures find the affected pairs
+        '''
+        self.forget_install(key)
+        links = set((node, port) for node in out_ports for port in out_ports[node])
+        self.installs[key] = {
+            'first_port': first_port,
+            'last_port': last_port,
+            'links': links,
+            'out_ports': out_ports,
+            'switches': set(out_ports),
+            'version': self.topology_version,
+            'backup_rules': set((node, in_port) for node in backup_rules
+                                for in_port in backup_rules[node]),
+        }
+        for link in links:
+            self.link_installs[link].add(key)
+
+    def forget_install(self, key):
+        self.install_requests.pop(key, None)
+        if key[0] is None:
+            self.metrics.remove('controller_tree_switches', (('ip_dst', key[3]),))
+        else:
+            self.metrics.remove('controller_pair_paths',
+                                (('ip_src', key[2]), ('ip_dst', key[3])))
+        install = self.installs.pop(key, None)
+        if install is None:
+            return
+        for link in install['links']:
+            self.link_installs[link].discard(key)
+            if not self.link_installs[link]:
+                del self.link_installs[link]
+
+    def remove_stale_flows(self, key, switches, backup_rules, batch):
+        '''
+        Delete the flows of a previous installation of the pair on switches
+        the new paths no longer cross, and its outdated in_port rules
+        '''
+        install = self.installs.get(key)
+        if install is None:
+            return
+        ip_src, ip_dst = key[2], key[3]
+        if ip_src is None:
+            # destination tree
+            for node in install['switches'] - switches:
+                dp = self.datapath_list.get(node)
+                if dp is not None:
+                    ofp_parser = dp.ofproto_parser
+                    self.delete_flow(dp, 32768, ofp_parser.OFPMatch(
+                        eth_type=0x0800, ipv4_dst=ip_dst), batch)
+                    self.delete_flow(dp, 1, ofp_parser.OFPMatch(
+                        eth_type=0x0806, arp_tpa=ip_dst), batch)
+            return
+        stale = [(node, None) for node in install['switches'] - switches]
+        stale += [(node, in_port) for node, in_port in install['backup_rules']
+                  if in_port not in backup_rules.get(node, {})]
+        for node, in_port in stale:
+            dp = self.datapath_list.get(node)
+            if dp is None:
+                continue
+            ofp_parser = dp.ofproto_parser
+            if in_port is None:
+                matches = [
+                    (32768, ofp_parser.OFPMatch(eth_type=0x0800, ipv4_src=ip_src, ipv4_dst=ip_dst)),
+                    (1, ofp_parser.OFPMatch(eth_type=0x0806, arp_spa=ip_src, arp_tpa=ip_dst))]
+            else:
+                matches = [
+                    (32769, ofp_parser.OFPMatch(in_port=in_port, eth_type=0x0800,
+                                                ipv4_src=ip_src, ipv4_dst=ip_dst)),
+                    (2, ofp_parser.OFPMatch(in_port=in_port, eth_type=0x0806,
+                                            arp_spa=ip_src, arp_tpa=ip_dst))]
+            for priority, match in matches:
+                self.delete_flow(dp, priority, match, batch)
+
+    def delete_flow(self, datapath, priority, match, batch=None):
+        if (datapath.id in self.resynced and
+                (priority, tuple(sorted(match.items()))) not in self.flows[datapath.id]):
+            # the switch does not hold the flow
+            self.metrics.inc('controller_suppressed_messages_total', (('type', 'flow_delete'),))
+            return
+        ofp = datapath.ofproto
+        mod = datapath.ofproto_parser.OFPFlowMod(
+            datapath=datapath, table_id=self.forwarding_table,
+            command=ofp.OFPFC_DELETE_STRICT, priority=priority, out_port=ofp.OFPP_ANY, out_group=ofp.OFPG_ANY, match=match)
+        if batch is not None:
+            batch.add(datapath, mod)
+        else:
+            self.send_msg(datapath, mod)
+        self.untrack_flow(datapath.id, priority, match, batch)
+
+    def expire_install(self, key):
+        '''
+        Remove all flows of an installed pair, e.g. after its ingress flow
+        timed out
+        '''
+        batch = MessageBatch()
+        self.unsplit_pair(key, batch)
+        self.remove_stale_flows(key, set(), {}, batch)
+        self.forget_install(key)
+        self.proactive_pairs.discard((key[2], key[3]))
+        self.send_batch(batch, None, f"expiry of {key[2]} -> {key[3]}")
+
+    def reroute_installs(self, keys, reason):
+        '''
+        Recompute and reinstall only the given pairs, e.g. the ones that used
+        a failed link, and report the reconvergence time once all switches
+        acknowledged the new rules
+        '''
+        keys = [key for key in keys if key in self.installs]
+        if not keys:
+            return
+        start = time.time()
+        outstanding = {'count': len(keys)}
+
+        def acknowledged():
+            outstanding['count'] -= 1
+            if outstanding['count'] == 0:
+                print ("Reconvergence of", len(keys), "paths after", reason,
+                       "acknowledged in", time.time() - start)
+
+        for key in keys:
+            src, dst, ip_src, ip_dst = key
+            install = self.installs[key]
+            # a reroute is never coalesced, the shadow keeps its messages minimal
+            self.install_requests.pop(key, None)
+            if src is None and dst in self.datapath_list:
+                self.install_destination_tree(dst, install['last_port'], ip_dst, acknowledged)
+            elif (src not in self.datapath_list or dst not in self.datapath_list
+                    or self.install_paths(src, install['first_port'], dst,
+                                          install['last_port'], ip_src, ip_dst,
+                                          acknowledged) is None):
+                self.forget_install(key)
+                acknowledged()
+        print ("Rerouted", len(keys), "paths after", reason, "in", time.time() - start)
+
+    def get_snapshot(self):
+        '''
+        Get the state needed for a warm restart as JSON serializable lists
+        '''
+        adjacency = [[s1, s2, port] for links in (self.adjacency, self.restored_adjacency)
+                     for s1 in links for s2, port in links[s1].items()]
+        return {
+            'hosts': self.hosts,
+            'arp_table': self.arp_table,
+            'adjacency': adjacency,
+            'bandwidths': [[dpid, port, bw] for dpid in self.bandwidths
+                           for port, bw in self.bandwidths[dpid].items()],
+            'multipath_group_ids': [[list(key), group_id] for key, group_id
+                                    in self.multipath_group_ids.items()],
+            'installs': [[list(key), install['first_port'], install['last_port'],
+                          [[node, ports] for node, ports in install['out_ports'].items()],
+                          sorted(install['backup_rules'])]
+                         for key, install in self.installs.items()],
+        }
+
+    def save_snapshot(self):
+        text = json.dumps(self.get_snapshot(), separators=(',', ':'))
+        if text == self.snapshot_text:
+            return
+        # write and rename, so a crash never leaves half a snapshot
+        with open(SNAPSHOT_FILE + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(SNAPSHOT_FILE + '.tmp', SNAPSHOT_FILE)
+        self.snapshot_text = text
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    def load_snapshot(self):
+        '''
+        Reload the state of a previous run. Its links are used as soon as both
+        switches are connected again, its installed pairs are verified
+        against the flows found on the switches
+        '''
+        try:
+            with open(SNAPSHOT_FILE) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print ("Ignoring snapshot", SNAPSHOT_FILE, ":", e)
+            return
+        self.hosts = dict((mac, tuple(location)) for mac, location in state['hosts'].items())
+        self.arp_table = state['arp_table']
+        for s1, s2, port in state['adjacency']:
+            self.restored_adjacency[s1][s2] = port
+        for dpid, port, bw in state['bandwidths']:
+            self.bandwidths[dpid][port] = bw
+        for key, group_id in state['multipath_group_ids']:
+            self.multipath_group_ids[tuple(key)] = group_id
+            self.group_allocators[key[0]].reserve([group_id])
+        for key, first_port, last_port, out_ports, backup_rules in state['installs']:
+            backup = defaultdict(list)
+            for node, in_port in backup_rules:
+                backup[node].append(in_port)
+            self.record_install(tuple(key), first_port, last_port,
+                                OrderedDict((node, ports) for node, ports in out_ports), backup)
+            self.unverified_installs.add(tuple(key))
+        self.snapshot_text = json.dumps(state, separators=(',', ':'))
+        print ("Restored", len(self.hosts), "hosts,", len(state['adjacency']) // 2,
+               "links and", len(self.installs), "paths from", SNAPSHOT_FILE)
+
+    def _snapshot_loop(self):
+        while True:
+            hub.sleep(SNAPSHOT_INTERVAL)
+            self.expire_restored_links()
+            self.save_snapshot()
+
+    def restore_links(self, dpid):
+        '''
+        Add the snapshot's links between dpid and the connected switches,
+        until LLDP rediscovers them
+        '''
+        for neighbor, port in list(self.restored_adjacency.get(dpid, {}).items()):
+            back = self.restored_adjacency.get(neighbor, {}).get(dpid)
+            if neighbor not in self.datapath_list or back is None:
+                continue
+            del self.restored_adjacency[dpid][neighbor]
+            del self.restored_adjacency[neighbor][dpid]
+            if neighbor in self.adjacency[dpid]:
+                continue
+            self.adjacency[dpid][neighbor] = port
+            self.adjacency[neighbor][dpid] = back
+            self.restored_links[dpid, neighbor] = time.time()
+
+    def expire_restored_links(self):
+        expired = [(s1, self.adjacency[s1].get(s2), s2, self.adjacency[s2].get(s1))
+                   for (s1, s2), since in self.restored_links.items()
+                   if time.time() - since >= SNAPSHOT_LINK_TIMEOUT]
+        if expired:
+            self.remove_links(expired, f"{len(expired)} links of the snapshot not rediscovered")
+
+    def start_resync(self, datapath):
+        '''
+        Read the flows and groups a switch kept while the controller was
+        away, instead of wiping them
+        '''
+        ofp = datapath.ofproto
+        ofp_parser = datapath.ofproto_parser
+        self.resyncs[datapath.id] = {'groups': set(), 'flows': [],
+                                     'groups_done': False, 'flows_done': False}
+        datapath.send_msg(ofp_parser.OFPGroupDescStatsRequest(datapath, 0))
+        req = ofp_parser.OFPFlowStatsRequest(
+            datapath, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY, ofp.OFPG_ANY, 0, 0,
+            ofp_parser.OFPMatch())
+        datapath.send_msg(req)
+        self.resyncs[datapath.id]['xid'] = req.xid
+        # kept after the resync, the other flow stats handlers may see the
+        # last reply after it finished
+        self.resync_xids.add((datapath.id, req.xid))
+        if self.recorder is not None:
+            self.recorder.record(EventRecorder.RESYNC, datapath.id,
+                                 EventRecorder.XID.pack(req.xid))
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply, MAIN_DISPATCHER)
+    def group_desc_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        resync = self.resyncs.get(dpid)
+        if resync is None:
+            return
+        resync['groups'].update(stat.group_id for stat in ev.msg.body)
+        if not ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            resync['groups_done'] = True
+            self.finish_resync(dpid)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def resync_flow_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        resync = self.resyncs.get(dpid)
+        if resync is None or ev.msg.xid != resync['xid']:
+            return
+        for stat in ev.msg.body:
+            if stat.table_id != self.forwarding_table:
+                continue
+            actions = []
+            for inst in stat.instructions:
+                actions += getattr(inst, 'actions', [])
+            resync['flows'].append((stat.priority, stat.match, actions))
+        if not ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            resync['flows_done'] = True
+            self.finish_resync(dpid)
+
+    def finish_resync(self, dpid):
+        resync = self.resyncs[dpid]
+        if not (resync['groups_done'] and resync['flows_done']):
+            return
+        del self.resyncs[dpid]
+        dp = self.datapath_list.get(dpid)
+        if dp is None:
+            return
+        groups = resync['groups']
+        self.group_allocators[dpid].reserve(groups)
+        for priority, match, actions in resync['flows']:
+            if priority > 0 and (priority, tuple(sorted(match.items()))) not in self.flows[dpid]:
+                self.track_flow(dpid, priority, match, actions)
+        # groups the switch lost, e.g. because it restarted as well
+        for group_key, group_id in list(self.multipath_group_ids.items()):
+            if group_key[0] == dpid and group_id not in groups:
+                del self.multipath_group_ids[group_key]
+        # groups no flow refers to anymore
+        referenced = set(group_id for d, group_id in self.group_refs if d == dpid)
+        referenced |= set(group_id for group_key, group_id in self.multipath_group_ids.items()
+                          if group_key[0] == dpid)
+        for group_id in groups - referenced:
+            self.send_msg(dp, dp.ofproto_parser.OFPGroupMod(
+                dp, dp.ofproto.OFPGC_DELETE, dp.ofproto.OFPGT_SELECT, group_id))
+            self.group_allocators[dpid].release(group_id)
+        self.resynced.add(dpid)
+        print ("Resynced switch", dpid, "with", len(resync['flows']), "flows and",
+               len(groups), "groups")
+
+        # restored pairs are reinstalled only if a switch lost their rules
+        missing = []
+        for key in list(self.unverified_installs):
+            install = self.installs.get(key)
+            if install is None:
+                self.unverified_installs.discard(key)
+                continue
+            if not install['switches'] <= self.resynced:
+                continue
+            self.unverified_installs.discard(key)
+            if key[2] is None:
+                fields = {'eth_type': 0x0800, 'ipv4_dst': key[3]}
+            else:
+                fields = {'eth_type': 0x0800, 'ipv4_src': key[2], 'ipv4_dst': key[3]}
+            rule = (32768, tuple(sorted(fields.items())))
+            if any(rule not in self.flows[node] for node in install['switches']):
+                missing.append(key)
+        self.reroute_installs(missing, f"resync of switch {dpid}")
+
+    def get_known_hosts(self):
+        '''
+        Get the location (dpid, port) of every host with a known IP
+        '''
+        known = {}
+        for ip_addr, host_mac in self.arp_table.items():
+            if host_mac in self.hosts and self.hosts[host_mac][0] in self.datapath_list:
+                known[ip_addr] = self.hosts[host_mac]
+        return known
+
+    def install_proactive_paths(self):
+        '''
+        Install the paths between all known hosts. Only pairs that are not
+        installed for the current topology yet are computed, so a newly
+        learned host only adds its own row and column of the pair matrix
+        '''
+        if self.proactive_version != self.topology_version:
+            self.proactive_pairs = set()
+            self.proactive_version = self.topology_version
+        known = self.get_known_hosts()
+        pairs = [(ip_src, ip_dst) for ip_src in known for ip_dst in known
+                 if ip_src != ip_dst and (ip_src, ip_dst) not in self.proactive_pairs]
+        if not pairs:
+            return
+        start = time.time()
+        waiting = set(pairs)
+
+        def acknowledged(pair):
+            if pair not in waiting:
+                return
+            waiting.discard(pair)
+            if not waiting:
+                print ("Proactive installation of", len(pairs), "paths for", len(known),
+                       "hosts acknowledged in", time.time() - start)
+
+        for ip_src, ip_dst in pairs:
+            h1 = known[ip_src]
+            h2 = known[ip_dst]
+            pair = (ip_src, ip_dst)
+            if self.install_paths(h1[0], h1[1], h2[0], h2[1], ip_src, ip_dst,
+                                  lambda pair=pair: acknowledged(pair)) is None:
+                # nothing was sent for the pair
+                acknowledged(pair)
+            self.proactive_pairs.add(pair)
+        print ("Proactive installation of", len(pairs), "paths for", len(known),
+               "hosts sent in", time.time() - start)
+
+    def preinstall_paths(self, pairs, hosts=(), timeout=PREINSTALL_TIMEOUT):
+        '''
+        Install the paths of all pairs in both directions with a single write
+        per switch and wait until the switches acknowledged them.
+        pairs are dicts with ip_src and ip_dst and optionally mac_src and
+        mac_dst, for IPs the controller has not seen in an ARP packet yet.
+        hosts announce hosts that have not sent any packet yet as dicts
+        with ip, mac, dpid and port
+        '''
+        start = time.time()
+        for host in hosts:
+            self.arp_table[host['ip']] = host['mac']
+            self.hosts[host['mac']] = (host['dpid'], host['port'])
+            if host['dpid'] in self.datapath_list:
+                self.add_qos_ingress(self.datapath_list[host['dpid']], host['port'])
+        batch = MessageBatch()
+        installed = []
+        unresolved = []
+        # an explicit request, every rule is sent even if the shadow has it
+        self.bypass_shadow = True
+        try:
+            for pair in pairs:
+                ip_src = pair['ip_src']
+                ip_dst = pair['ip_dst']
+                h1 = self.hosts.get(pair.get('mac_src') or self.arp_table.get(ip_src))
+                h2 = self.hosts.get(pair.get('mac_dst') or self.arp_table.get(ip_dst))
+                if (h1 is None or h2 is None or h1[0] not in self.datapath_list
+                        or h2[0] not in self.datapath_list):
+                    unresolved.append([ip_src, ip_dst])
+                    continue
+                if (self.install_paths(h1[0], h1[1], h2[0], h2[1], ip_src, ip_dst,
+                                       batch=batch) is None or
+                        self.install_paths(h2[0], h2[1], h1[0], h1[1], ip_dst, ip_src,
+                                           batch=batch) is None):
+                    unresolved.append([ip_src, ip_dst])
+                    continue
+                installed.append([ip_src, ip_dst])
+        finally:
+            self.bypass_shadow = False
+
+        # no traffic is expected yet, so all switches are written at once
+        done = hub.Event()
+        self.send_batch(batch, None, f"pre-installation of {len(installed)} pairs",
+                        done.set)
+        acknowledged = done.wait(timeout)
+        print ("Pre-installed", len(installed), "pairs,", len(unresolved),
+               "unresolved, acknowledged:", acknowledged, "in", time.time() - start)
+        return {
+            'installed': installed,
+            'unresolved': unresolved,
+            'acknowledged': acknowledged,
+            'seconds': time.time() - start,
+        }
+
+    def _proactive_loop(self):
+        while True:
+            hub.sleep(1)
+            if time.time() - self.last_topology_change >= PROACTIVE_SETTLE_TIME:
+                try:
+                    self.install_proactive_paths()
+                except Exception as e:
+                    # e.g. a switch left meanwhile, the pairs not installed
+                    # yet are tried again in the next round
+                    print ("Proactive installation failed:", repr(e))
+
+    def write_messages(self, datapath, msgs):
+        '''
+        Serialize msgs followed by a barrier into a single write to the
+        datapath. Returns the xid of the barrier
+        '''
+        barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        bufs = []
+        for msg in msgs:
+            self.count_message(datapath, msg)
+        for msg in msgs + [barrier]:
+            if msg.xid is None:
+                datapath.set_xid(msg)
+            msg.serialize()
+            bufs.append(bytes(msg.buf))
+        datapath.send(b''.join(bufs))
+        return barrier.xid
+
+    def count_message(self, datapath, msg):
+        if msg.cls_msg_type == datapath.ofproto.OFPT_FLOW_MOD:
+            self.metrics.inc('controller_flow_mods_total', (('dpid', datapath.id),))
+        elif msg.cls_msg_type == datapath.ofproto.OFPT_GROUP_MOD:
+            self.metrics.inc('controller_group_mods_total', (('dpid', datapath.id),))
+
+    def send_msg(self, datapath, msg):
+        '''
+        Send a single FlowMod or GroupMod outside of a batch
+        '''
+        self.count_message(datapath, msg)
+        datapath.send_msg(msg)
+
+    def send_batch(self, batch, ingress, label, callback=None):
+        '''
+        Send a batch to the switches, in the order it was filled.
+        The ingress switch is written only after all other switches confirmed
+        their barrier, so no packet enters a path that is not complete yet.
+        The install is finished when the ingress barrier reply arrives.
+        Return the id of the install
+        '''
+        install_id = self.next_install_id
+        self.next_install_id += 1
+        install = {
+            'label': label,
+            'start': time.time(),
+            'waiting': set(),
+            'deferred': batch.messages.get(ingress),
+            'switches': len(batch.messages),
+            'callbacks': [callback] if callback is not None else [],
+        }
+        self.pending_installs[install_id] = install
+        for dpid, (dp, msgs) in batch.messages.items():
+            if dpid == ingress:
+                continue
+            self.barrier_xids[dpid, self.write_messages(dp, msgs)] = install_id
+            install['waiting'].add(dpid)
+        self._check_install(install_id)
+        return install_id
+
+    def join_install(self, install_id, callback):
+        '''
+        Call callback when the install is acknowledged, or at once if it is
+        already
+        '''
+        if callback is None:
+            return
+        install = self.pending_installs.get(install_id)
+        if install is None:
+            callback()
+        else:
+            install['callbacks'].append(callback)
+
+    def _check_install(self, install_id):
+        install = self.pending_installs[install_id]
+        if install['waiting']:
+            return
+        deferred = install['deferred']
+        if deferred is not None and deferred[0].id in self.datapath_list:
+            install['deferred'] = None
+            dp, msgs = deferred
+            self.barrier_xids[dp.id, self.write_messages(dp, msgs)] = install_id
+            install['waiting'].add(dp.id)
+            return
+        del self.pending_installs[install_id]
+        latency = time.time() - install['start']
+        self.install_latencies.append(latency)
+        self.metrics.observe('controller_install_ack_seconds', latency)
+        print ("Path", install['label'], "acknowledged by", install['switches'],
+               "switches in", latency)
+        for callback in install['callbacks']:
+            callback()
+
+    def _barrier_done(self, dpid, install_id):
+        install = self.pending_installs.get(install_id)
+        if install is None:
+            return
+        install['waiting'].discard(dpid)
+        self._check_install(install_id)
+
+    def add_path_flow(self, datapath, priority, match, actions, batch, ingress=False):
+        '''
+        Add a flow of an installed path. Only flows on the ingress switch
+        idle out, the others are removed together with them
+        '''
+        self.add_flow(datapath, priority, match, actions, batch=batch,
+                      idle_timeout=FLOW_IDLE_TIMEOUT if ingress else 0,
+                      hard_timeout=FLOW_HARD_TIMEOUT,
+                      flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 batch=None, idle_timeout=0, hard_timeout=0, flags=0, cookie=0):
         # print "Adding flow ", match, actions
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        key = (priority, tuple(sorted(match.items())))
+        rule = (get_actions_signature(actions), idle_timeout, hard_timeout, flags, cookie)
+        if (not buffer_id and not self.bypass_shadow
+                and self.shadow_flows[datapath.id].get(key) == rule):
+            self.metrics.inc('controller_suppressed_messages_total', (('type', 'flow_mod'),))
+            return
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
         if buffer_id:
-            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=self.forwarding_table,
+                                    buffer_id=buffer_id, cookie=cookie,
                                     priority=priority, match=match,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
+                                    instructions=inst)
+        else:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=self.forwarding_table,
+                                    cookie=cookie, priority=priority,
+                                    match=match, idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
                                     instructions=inst)
+        if batch is not None:
+            batch.add(datapath, mod)
         else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+            self.send_msg(datapath, mod)
+        self.track_flow(datapath.id, priority, match, actions, batch)
+        self.shadow_flows[datapath.id][key] = rule
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        msg = ev.msg
+        dp = msg.datapath
+        ofp = dp.ofproto
+        self.untrack_flow(dp.id, msg.priority, msg.match)
+        if msg.priority == ELEPHANT_PRIORITY:
+            pin = (dp.id, tuple(sorted(msg.match.items())))
+            if pin in self.elephants:
+                self.unpin_elephant(pin)
+            return
+        if (msg.reason in (ofp.OFPRR_IDLE_TIMEOUT, ofp.OFPRR_HARD_TIMEOUT)
+                and msg.priority in (32768, SPLIT_PRIORITY)
+                and msg.match.get('eth_type') == 0x0800
+                and 'in_port' not in msg.match):
+            ip_src = msg.match.get('ipv4_src')
+            ip_dst = msg.match.get('ipv4_dst')
+            if ip_src is None:
+                # a rule of a destination tree, the whole tree is installed again
+                for key in [k for k in self.installs if k[0] is None and k[3] == ip_dst]:
+                    self.expire_install(key)
+                return
+            if msg.priority == 32768 and (dp.id, ip_src, ip_dst) in self.split_pairs:
+                # the split rule carries the pair's traffic now
+                return
+            for key in [k for k in self.installs
+                        if k[0] == dp.id and k[2] == ip_src and k[3] == ip_dst]:
+                self.expire_install(key)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        install_id = self.barrier_xids.pop((dpid, ev.msg.xid), None)
+        if install_id is not None:
+            self._barrier_done(dpid, install_id)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def _switch_features_handler(self, ev):
         print ("switch_features_handler is called")
         datapath = ev.msg.datapath
+        # the switch (re)connected and may have lost its rules meanwhile
+        self.shadow_flows.pop(datapath.id, None)
+        for key in [k for k in self.shadow_groups if k[0] == datapath.id]:
+            del self.shadow_groups[key]
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
@@ -248,41 +2436,620 @@ class ProjectController(app_manager.RyuApp):
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
                                           ofproto.OFPCML_NO_BUFFER)]
         self.add_flow(datapath, 0, match, actions)
+        if QOS_ENABLED:
+            self.install_qos(datapath)
+
+    def install_qos(self, datapath):
+        '''
+        Install the meters and the classifier table of a switch that just
+        connected, with the ingress rules of the hosts known at it
+        '''
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        self.qos_rules[datapath.id] = set()
+        for index, qos_class in enumerate(QOS_CLASSES):
+            if qos_class.get('rate'):
+                flags = ofproto.OFPMF_KBPS
+                if qos_class.get('burst'):
+                    flags |= ofproto.OFPMF_BURST
+                bands = [parser.OFPMeterBandDrop(rate=qos_class['rate'],
+                                                 burst_size=qos_class.get('burst', 0))]
+                # the meter may survive from a previous connection, deleting
+                # a missing meter is no error. The delete also removes the
+                # ingress rules using it, they are added again below
+                self.send_msg(datapath, parser.OFPMeterMod(
+                    datapath, ofproto.OFPMC_DELETE, 0, index + 1))
+                self.send_msg(datapath, parser.OFPMeterMod(
+                    datapath, ofproto.OFPMC_ADD, flags, index + 1, bands))
+            for fields in get_qos_matches(qos_class):
+                self.add_qos_flow(datapath, QOS_PRIORITY - index, fields, qos_class['queue'])
+        # packets of no class go to the forwarding table unchanged
+        self.add_qos_flow(datapath, 0, {})
+        for dpid, port in set(self.hosts.values()):
+            if dpid == datapath.id:
+                self.add_qos_ingress(datapath, port)
+
+    def add_qos_ingress(self, datapath, port):
+        '''
+        Police the packets a host sends into port with the meters of their
+        classes. The ingress rules take precedence over all class rules
+        '''
+        if not QOS_ENABLED or port in self.adjacency[datapath.id].values():
+            return
+        for index, qos_class in enumerate(QOS_CLASSES):
+            for fields in get_qos_matches(qos_class):
+                self.add_qos_flow(datapath, QOS_PRIORITY + len(QOS_CLASSES) - index,
+                                  dict(fields, in_port=port), qos_class['queue'],
+                                  index + 1 if qos_class.get('rate') else None)
+
+    def add_qos_flow(self, datapath, priority, fields, queue=None, meter_id=None):
+        key = (priority, tuple(sorted(fields.items())))
+        if key in self.qos_rules[datapath.id]:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        inst = []
+        if meter_id is not None:
+            inst.append(parser.OFPInstructionMeter(meter_id, ofproto.OFPIT_METER))
+        if queue is not None:
+            inst.append(parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                                     [parser.OFPActionSetQueue(queue)]))
+        inst.append(parser.OFPInstructionGotoTable(self.forwarding_table))
+        self.send_msg(datapath, parser.OFPFlowMod(
+            datapath=datapath, table_id=0, priority=priority,
+            match=parser.OFPMatch(**fields), instructions=inst))
+        self.qos_rules[datapath.id].add(key)
 
     @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
     def port_desc_stats_reply_handler(self, ev):
         switch = ev.msg.datapath
+        changed = False
+        self.switch_ports[switch.id] = set(
+            p.port_no for p in ev.msg.body if p.port_no <= switch.ofproto.OFPP_MAX)
+        if FLOOD_MODE == 'tree':
+            self.update_flood_rules(switch.id)
         for p in ev.msg.body:
+            if self.bandwidths[switch.id][p.port_no] != p.curr_speed:
+                changed = True
             self.bandwidths[switch.id][p.port_no] = p.curr_speed
+        if changed:
+            # link costs changed, any cached path may no longer be optimal
+            self.path_cache.bump_version()
+
+    def _port_stats_loop(self):
+        while True:
+            for dp in list(self.datapath_list.values()):
+                req = dp.ofproto_parser.OFPPortStatsRequest(dp, 0, dp.ofproto.OFPP_ANY)
+                dp.send_msg(req)
+            hub.sleep(PORT_STATS_INTERVAL)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def port_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        if (dpid, ev.msg.xid) in self.stats_xids:
+            # sampled by the statistics collector
+            return
+        changed = False
+        for stat in ev.msg.body:
+            key = (dpid, stat.port_no)
+            now = stat.duration_sec + stat.duration_nsec / 1e9
+            prev = self.port_tx_bytes.get(key)
+            self.port_tx_bytes[key] = (stat.tx_bytes, now)
+            if prev is None or now <= prev[1] or stat.tx_bytes < prev[0]:
+                continue
+            rate = (stat.tx_bytes - prev[0]) * 8 / 1000.0 / (now - prev[1])
+            utilization = self.port_utilization[dpid].get(stat.port_no)
+            if utilization is None:
+                utilization = rate
+            else:
+                utilization = UTILIZATION_ALPHA * rate + (1 - UTILIZATION_ALPHA) * utilization
+            self.port_utilization[dpid][stat.port_no] = utilization
+
+            residual = self.get_residual_bw(dpid, stat.port_no)
+            last = self.cost_residuals.get(key, self.get_port_capacity(dpid, stat.port_no))
+            if abs(residual - last) > COST_CHANGE_THRESHOLD * last:
+                self.cost_residuals[key] = residual
+                changed = True
+        if changed:
+            # link costs changed, any cached path may no longer be optimal
+            self.path_cache.bump_version()
+
+    def _delay_probe_loop(self):
+        '''
+        Send an echo request to every switch and a probe packet over every
+        link. A probe returns from the far switch by its table-miss flow
+        '''
+        while True:
+            for dpid, dp in list(self.datapath_list.items()):
+                parser = dp.ofproto_parser
+                dp.send_msg(parser.OFPEchoRequest(dp, data=struct.pack('!d', time.time())))
+                for neighbor, port in list(self.adjacency[dpid].items()):
+                    pkt = packet.Packet()
+                    pkt.add_protocol(ethernet.ethernet(
+                        ethertype=PROBE_ETHERTYPE, src='02:00:00:00:00:01', dst='02:00:00:00:00:02'))
+                    pkt.add_protocol(struct.pack('!QId', dpid, port, time.time()))
+                    pkt.serialize()
+                    actions = [parser.OFPActionOutput(port)]
+                    dp.send_msg(parser.OFPPacketOut(
+                        datapath=dp, buffer_id=dp.ofproto.OFP_NO_BUFFER,
+                        in_port=dp.ofproto.OFPP_CONTROLLER, actions=actions, data=pkt.data))
+            hub.sleep(DELAY_PROBE_INTERVAL)
+
+    @set_ev_cls(ofp_event.EventOFPEchoReply, MAIN_DISPATCHER)
+    def echo_reply_handler(self, ev):
+        if len(ev.msg.data) != 8:
+            return
+        sent, = struct.unpack('!d', ev.msg.data)
+        self.echo_rtts[ev.msg.datapath.id] = max(time.time() - sent, 0)
+
+    def handle_delay_probe(self, msg):
+        '''
+        Update the delay of the link a probe was sent over: the time from
+        sending to the packet-in minus half the echo RTT of both switches
+        '''
+        received = time.time()
+        dst = msg.datapath.id
+        payload = msg.data[14:14 + 20]
+        if len(payload) != 20:
+            return
+        src, port, sent = struct.unpack('!QId', payload)
+        if self.adjacency[src].get(dst) != port or src not in self.echo_rtts \
+                or dst not in self.echo_rtts:
+            return
+        delay = received - sent - (self.echo_rtts[src] + self.echo_rtts[dst]) / 2
+        delay = max(delay, 0) * 1000
+        last = self.link_delays.get((src, dst))
+        if last is not None:
+            delay = DELAY_ALPHA * delay + (1 - DELAY_ALPHA) * last
+        self.link_delays[src, dst] = delay
+
+        if LINK_COST_MODE == 'bandwidth':
+            return
+        last = self.cost_delays.get((src, dst), DEFAULT_LINK_DELAY)
+        if abs(delay - last) > COST_CHANGE_THRESHOLD * max(last, 0.1):
+            self.cost_delays[src, dst] = delay
+            # link costs changed, any cached path may no longer be optimal
+            self.path_cache.bump_version()
+
+    def register_select_group(self, dpid, group_id, buckets):
+        '''
+        Remember the buckets of a SELECT group as (port, weight, links) with
+        the (dpid, out_port) links of the bucket's path to the destination
+        '''
+        old = self.select_groups.get((dpid, group_id))
+        if old is None or [b[0] for b in old] != [b[0] for b in buckets]:
+            # other ports, the byte counters of the buckets start over
+            self.group_bucket_bytes.pop((dpid, group_id), None)
+            self.group_bucket_rates.pop((dpid, group_id), None)
+        self.select_groups[dpid, group_id] = buckets
+
+    def forget_select_group(self, dpid, group_id):
+        self.select_groups.pop((dpid, group_id), None)
+        self.group_bucket_bytes.pop((dpid, group_id), None)
+        self.group_bucket_rates.pop((dpid, group_id), None)
+
+    def _rebalance_loop(self):
+        while True:
+            hub.sleep(REBALANCE_INTERVAL)
+            for dpid in set(dpid for dpid, group_id in self.select_groups):
+                dp = self.datapath_list.get(dpid)
+                if dp is not None:
+                    req = dp.ofproto_parser.OFPGroupStatsRequest(dp, 0, dp.ofproto.OFPG_ALL)
+                    dp.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPGroupStatsReply, MAIN_DISPATCHER)
+    def group_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        if (dpid, ev.msg.xid) in self.stats_xids:
+            # sampled by the statistics collector
+            return
+        for stat in ev.msg.body:
+            key = (dpid, stat.group_id)
+            buckets = self.select_groups.get(key)
+            if buckets is None or len(stat.bucket_stats) != len(buckets):
+                continue
+            now = stat.duration_sec + stat.duration_nsec / 1e9
+            byte_counts = [bucket.byte_count for bucket in stat.bucket_stats]
+            prev = self.group_bucket_bytes.get(key)
+            self.group_bucket_bytes[key] = (byte_counts, now)
+            if (prev is None or now <= prev[1]
+                    or any(b < p for b, p in zip(byte_counts, prev[0]))):
+                continue
+            rates = [(b - p) * 8 / 1000.0 / (now - prev[1])
+                     for b, p in zip(byte_counts, prev[0])]
+            old_rates = self.group_bucket_rates.get(key)
+            if old_rates is not None:
+                rates = [UTILIZATION_ALPHA * rate + (1 - UTILIZATION_ALPHA) * old
+                         for rate, old in zip(rates, old_rates)]
+            self.group_bucket_rates[key] = rates
+            self.rebalance_group(dpid, stat.group_id)
+
+    def rebalance_group(self, dpid, group_id):
+        '''
+        Weight the buckets of a SELECT group by the residual bandwidth of the
+        bottleneck on their paths. The group's own traffic counts as
+        available, otherwise it pushes itself from bucket to bucket.
+        The group is modified only if a bucket's share changes by more than
+        REBALANCE_THRESHOLD
+        '''
+        buckets = self.select_groups[dpid, group_id]
+        rates = self.group_bucket_rates[dpid, group_id]
+        available = []
+        for (port, weight, links), rate in zip(buckets, rates):
+            available.append(min(
+                min(self.get_residual_bw(s, p) + rate, self.get_port_capacity(s, p))
+                for s, p in links))
+        total = sum(available)
+        weights = [max(1, int(round(a / total * BUCKET_WEIGHT_SCALE))) for a in available]
+        old_total = float(sum(b[1] for b in buckets))
+        new_total = float(sum(weights))
+        if all(abs(w / new_total - b[1] / old_total) <= REBALANCE_THRESHOLD
+               for w, b in zip(weights, buckets)):
+            return
+
+        dp = self.datapath_list[dpid]
+        ofp = dp.ofproto
+        ofp_parser = dp.ofproto_parser
+        self.add_group(
+            dp, ofp.OFPGC_MODIFY, ofp.OFPGT_SELECT, group_id,
+            [ofp_parser.OFPBucket(weight=weight, watch_port=port,
+                                  watch_group=ofp.OFPG_ANY,
+                                  actions=[ofp_parser.OFPActionOutput(port)])
+             for weight, (port, old_weight, links) in zip(weights, buckets)])
+        self.select_groups[dpid, group_id] = [
+            (port, weight, links) for weight, (port, old_weight, links) in zip(weights, buckets)]
+        self.metrics.inc('controller_group_rebalances_total', (('dpid', dpid),))
+        print ("Rebalanced group", group_id, "on switch", dpid, "to weights",
+               dict((b[0], w) for w, b in zip(weights, buckets)))
+
+    def get_ingress_actions(self, key):
+        '''
+        Get the actions of the ingress rule of an installed pair
+        '''
+        src, dst = key[0], key[1]
+        ofp_parser = self.datapath_list[src].ofproto_parser
+        out_ports = self.installs[key]['out_ports'][src]
+        group_id = self.multipath_group_ids.get((src, src, dst))
+        if len(out_ports) > 1 and group_id is not None:
+            return [ofp_parser.OFPActionGroup(group_id)]
+        return [ofp_parser.OFPActionOutput(out_ports[0])]
+
+    def _elephant_loop(self):
+        while True:
+            hub.sleep(ELEPHANT_INTERVAL)
+            # forget the counters of flows that are gone
+            now = time.time()
+            for key in [k for k, v in self.flow_bytes.items()
+                        if now - v[2] > 3 * ELEPHANT_INTERVAL]:
+                del self.flow_bytes[key]
+            for dpid in set(key[0] for key in self.installs if key[0] is not None):
+                dp = self.datapath_list.get(dpid)
+                if dp is None:
+                    continue
+                ofp = dp.ofproto
+                ofp_parser = dp.ofproto_parser
+                req = ofp_parser.OFPFlowStatsRequest(
+                    dp, 0, self.forwarding_table, ofp.OFPP_ANY, ofp.OFPG_ANY, 0, 0,
+                    ofp_parser.OFPMatch(eth_type=0x0800))
+                dp.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def flow_stats_reply_handler(self, ev):
+        dpid = ev.msg.datapath.id
+        if (dpid, ev.msg.xid) in self.resync_xids:
+            return
+        if (dpid, ev.msg.xid) in self.stats_xids:
+            # sampled by the statistics collector
+            return
+        if not ELEPHANT_INTERVAL:
+            return
+        ingress = dict(((k[0], k[2], k[3]), k) for k in self.installs if k[0] == dpid)
+        # rates of the elephants pinned during this reply
+        pinned = defaultdict(float)
+        for stat in ev.msg.body:
+            if stat.priority not in (32768, MICROFLOW_PRIORITY):
+                continue
+            items = tuple(sorted(stat.match.items()))
+            now = stat.duration_sec + stat.duration_nsec / 1e9
+            prev = self.flow_bytes.get((dpid, stat.priority, items))
+            self.flow_bytes[dpid, stat.priority, items] = (stat.byte_count, now, time.time())
+            if prev is None or now <= prev[1] or stat.byte_count < prev[0]:
+                continue
+            rate = (stat.byte_count - prev[0]) * 8 / 1000.0 / (now - prev[1])
+            if rate < ELEPHANT_RATE:
+                continue
+            match = dict(items)
+            if stat.priority == MICROFLOW_PRIORITY:
+                if (dpid, items) not in self.elephants:
+                    self.pin_elephant(dpid, items, rate, pinned)
+                continue
+            pair = (dpid, match.get('ipv4_src'), match.get('ipv4_dst'))
+            if 'in_port' not in match and pair in ingress and pair not in self.split_pairs:
+                self.split_pair(ingress[pair])
+
+    def split_pair(self, key):
+        '''
+        Copy the packets of a pair to the controller at its ingress switch,
+        which adds a counting rule per 5-tuple
+        '''
+        src, dst, ip_src, ip_dst = key
+        dp = self.datapath_list[src]
+        ofp = dp.ofproto
+        ofp_parser = dp.ofproto_parser
+        # the headers are enough
+        actions = self.get_ingress_actions(key) + [
+            ofp_parser.OFPActionOutput(ofp.OFPP_CONTROLLER, 128)]
+        match = ofp_parser.OFPMatch(eth_type=0x0800, ipv4_src=ip_src, ipv4_dst=ip_dst)
+        self.add_flow(dp, SPLIT_PRIORITY, match, actions,
+                      idle_timeout=FLOW_IDLE_TIMEOUT, hard_timeout=FLOW_HARD_TIMEOUT,
+                      flags=ofp.OFPFF_SEND_FLOW_REM, cookie=SPLIT_COOKIE)
+        self.split_pairs[src, ip_src, ip_dst] = key
+        # the next install of the pair must not be collapsed, it unsplits it
+        self.install_requests.pop(key, None)
+        print ("Pair", ip_src, "->", ip_dst, "exceeds", ELEPHANT_RATE,
+               "kbit/s, counting its flows on switch", src)
+
+    def add_microflow(self, datapath, pkt, ip_pkt):
+        '''
+        Add a counting rule for the 5-tuple of a packet of a split pair,
+        forwarding like the pair's ingress rule
+        '''
+        key = self.split_pairs.get((datapath.id, ip_pkt.src, ip_pkt.dst))
+        if key is None or key not in self.installs:
+            return
+        fields = {'eth_type': 0x0800, 'ipv4_src': ip_pkt.src,
+                  'ipv4_dst': ip_pkt.dst, 'ip_proto': ip_pkt.proto}
+        tcp_pkt = pkt.get_protocol(tcp.tcp)
+        udp_pkt = pkt.get_protocol(udp.udp)
+        if tcp_pkt:
+            fields.update(tcp_src=tcp_pkt.src_port, tcp_dst=tcp_pkt.dst_port)
+        elif udp_pkt:
+            fields.update(udp_src=udp_pkt.src_port, udp_dst=udp_pkt.dst_port)
+        if (MICROFLOW_PRIORITY, tuple(sorted(fields.items()))) in self.flows[datapath.id]:
+            # more copies arrived before the rule
+            return
+        self.add_flow(datapath, MICROFLOW_PRIORITY,
+                      datapath.ofproto_parser.OFPMatch(**fields),
+                      self.get_ingress_actions(key),
+                      idle_timeout=MICROFLOW_IDLE_TIMEOUT,
+                      flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+
+    def pin_elephant(self, dpid, items, rate, pinned):
+        '''
+        Pin a 5-tuple to the pair's path with the most residual bandwidth on
+        its bottleneck, with exact rules above the pair rules on every hop
+        '''
+        fields = dict(items)
+        key = self.split_pairs.get((dpid, fields['ipv4_src'], fields['ipv4_dst']))
+        install = self.installs.get(key)
+        if install is None:
+            return
+        src, dst = key[0], key[1]
+        paths, pw = self.get_cached_paths(src, dst)
+        if len(paths) < 2:
+            return
+
+        def available(path):
+            return min(self.get_residual_bw(s1, self.adjacency[s1][s2])
+                       - pinned[s1, self.adjacency[s1][s2]]
+                       for s1, s2 in zip(path[:-1], path[1:]))
+
+        path = max(paths, key=available)
+        ports = self.add_ports_to_paths([path], install['first_port'], install['last_port'])[0]
+        batch = MessageBatch()
+        rules = []
+        for node in reversed(path):
+            dp = self.datapath_list[node]
+            match = dp.ofproto_parser.OFPMatch(**fields)
+            out_port = ports[node][1]
+            self.add_flow(dp, ELEPHANT_PRIORITY, match,
+                          [dp.ofproto_parser.OFPActionOutput(out_port)], batch=batch,
+                          idle_timeout=MICROFLOW_IDLE_TIMEOUT,
+                          flags=dp.ofproto.OFPFF_SEND_FLOW_REM)
+            rules.append((node, match))
+            pinned[node, out_port] += rate
+        self.elephants[dpid, items] = rules
+        self.metrics.inc('controller_elephants_pinned_total')
+        self.send_batch(batch, src, f"elephant {fields} at {rate:.0f} kbit/s on {path}")
+
+    def unpin_elephant(self, pin, batch=None):
+        for node, match in self.elephants.pop(pin):
+            dp = self.datapath_list.get(node)
+            if dp is not None:
+                self.delete_flow(dp, ELEPHANT_PRIORITY, match, batch)
+
+    def unsplit_pair(self, key, batch=None):
+        '''
+        Remove the split rule, the 5-tuple rules and the pinned elephants of a
+        pair, e.g. before its paths change
+        '''
+        src, dst, ip_src, ip_dst = key
+        if self.split_pairs.pop((src, ip_src, ip_dst), None) is None:
+            return
+        for pin in [p for p in self.elephants if p[0] == src
+                    and ('ipv4_src', ip_src) in p[1] and ('ipv4_dst', ip_dst) in p[1]]:
+            self.unpin_elephant(pin, batch)
+        dp = self.datapath_list.get(src)
+        if dp is None:
+            return
+        ofp_parser = dp.ofproto_parser
+        self.delete_flow(dp, SPLIT_PRIORITY, ofp_parser.OFPMatch(
+            eth_type=0x0800, ipv4_src=ip_src, ipv4_dst=ip_dst), batch)
+        for priority, items in [k for k in self.flows[src] if k[0] == MICROFLOW_PRIORITY]:
+            fields = dict(items)
+            if fields['ipv4_src'] == ip_src and fields['ipv4_dst'] == ip_dst:
+                self.delete_flow(dp, priority, ofp_parser.OFPMatch(**fields), batch)
+
+    def _stats_loop(self):
+        '''
+        Request the statistics of all switches. The replies only buffer their
+        rows, which are written in a native thread at the start of the next
+        round
+        '''
+        while True:
+            hub.sleep(STATS_INTERVAL)
+            now = time.time()
+            # replies that did not arrive within two rounds are not expected anymore
+            for key in [k for k, sent in self.stats_xids.items()
+                        if now - sent > 2 * STATS_INTERVAL]:
+                del self.stats_xids[key]
+            rows = self.stats_writer.take()
+            if rows:
+                try:
+                    tpool.execute(self.stats_writer.write, rows)
+                except Exception as e:
+                    # e.g. a full disk, the next rounds try again
+                    print ("Writing statistics to", self.stats_writer.path, "failed:", repr(e))
+            for dpid, dp in list(self.datapath_list.items()):
+                ofp = dp.ofproto
+                ofp_parser = dp.ofproto_parser
+                for req in (ofp_parser.OFPFlowStatsRequest(
+                                dp, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY, ofp.OFPG_ANY, 0, 0,
+                                ofp_parser.OFPMatch()),
+                            ofp_parser.OFPGroupStatsRequest(dp, 0, ofp.OFPG_ALL),
+                            ofp_parser.OFPPortStatsRequest(dp, 0, ofp.OFPP_ANY)):
+                    dp.send_msg(req)
+                    self.stats_xids[dpid, req.xid] = now
+
+    def close(self):
+        '''
+        Called by ryu when the app stops, writes the rows of the last round
+        '''
+        if STATS_INTERVAL:
+            hub.kill(self.stats_thread)
+            try:
+                self.stats_writer.write(self.stats_writer.take())
+            except Exception as e:
+                print ("Writing statistics to", self.stats_writer.path, "failed:", repr(e))
+            self.stats_writer.file.close()
+        if self.recorder is not None:
+            self.recorder.file.close()
+
+    @set_ev_cls([ofp_event.EventOFPFlowStatsReply, ofp_event.EventOFPGroupStatsReply,
+                 ofp_event.EventOFPPortStatsReply], MAIN_DISPATCHER)
+    def stats_collector_handler(self, ev):
+        msg = ev.msg
+        dpid = msg.datapath.id
+        if (dpid, msg.xid) not in self.stats_xids:
+            return
+        now = time.time()
+        if isinstance(ev, ofp_event.EventOFPFlowStatsReply):
+            table = 'flow'
+            for stat in msg.body:
+                match = json.dumps(dict(stat.match.items()), sort_keys=True)
+                self.stats_writer.add(table, (
+                    now, dpid, stat.table_id, stat.priority, stat.cookie, match,
+                    stat.duration_sec + stat.duration_nsec / 1e9,
+                    stat.packet_count, stat.byte_count))
+        elif isinstance(ev, ofp_event.EventOFPGroupStatsReply):
+            table = 'group'
+            for stat in msg.body:
+                duration = stat.duration_sec + stat.duration_nsec / 1e9
+                self.stats_writer.add(table, (now, dpid, stat.group_id, -1, duration,
+                                              stat.packet_count, stat.byte_count))
+                for bucket, counter in enumerate(stat.bucket_stats):
+                    self.stats_writer.add(table, (now, dpid, stat.group_id, bucket, duration,
+                                                  counter.packet_count, counter.byte_count))
+        else:
+            table = 'port'
+            for stat in msg.body:
+                self.stats_writer.add(table, (
+                    now, dpid, stat.port_no, stat.duration_sec + stat.duration_nsec / 1e9,
+                    stat.rx_packets, stat.tx_packets, stat.rx_bytes, stat.tx_bytes,
+                    stat.rx_dropped, stat.tx_dropped, stat.rx_errors, stat.tx_errors))
+        self.metrics.inc('controller_stats_samples_total', (('table', table),), len(msg.body))
+
+    @set_ev_cls([event.EventSwitchEnter, event.EventSwitchLeave, event.EventLinkAdd,
+                 event.EventLinkDelete, ofp_event.EventOFPPacketIn,
+                 ofp_event.EventOFPPortDescStatsReply, ofp_event.EventOFPPortStatsReply,
+                 ofp_event.EventOFPFlowStatsReply, ofp_event.EventOFPGroupStatsReply,
+                 ofp_event.EventOFPGroupDescStatsReply, ofp_event.EventOFPFlowRemoved],
+                MAIN_DISPATCHER)
+    def record_event_handler(self, ev):
+        if self.recorder is None:
+            return
+        msg = getattr(ev, 'msg', None)
+        if msg is not None and (msg.datapath.id, msg.xid) in self.stats_xids:
+            # samples of the statistics collector, a replay would take them
+            # for the samples of the other stats handlers
+            return
+        self.recorder.record_event(ev)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
+        start = time.perf_counter()
+        try:
+            self.handle_packet_in(ev)
+        finally:
+            self.metrics.observe('controller_packet_in_seconds',
+                                 time.perf_counter() - start)
+
+    def handle_packet_in(self, ev):
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        in_port = msg.match['in_port']
 
         pkt = packet.Packet(msg.data)
         eth = pkt.get_protocol(ethernet.ethernet)
-        arp_pkt = pkt.get_protocol(arp.arp)
+        ip_pkt = pkt.get_protocol(ipv4.ipv4)
 
         # avoid broadcast from LLDP
         if eth.ethertype == 35020:
             return
 
+        if eth.ethertype == PROBE_ETHERTYPE:
+            self.handle_delay_probe(msg)
+            return
+
+        self.packet_in_counts[eth.ethertype] += 1
+        self.metrics.inc('controller_packet_ins_total',
+                         (('ethertype', hex(eth.ethertype)),))
+        self.packet_in_total += 1
+        if self.packet_in_total % PACKET_IN_REPORT == 0:
+            print ("Packet-ins so far:", self.packet_in_total, "by ethertype:",
+                   dict(self.packet_in_counts))
+            print ("Flow table occupancy:", self.get_table_occupancy())
+
+        if msg.cookie == SPLIT_COOKIE:
+            # copy of a packet of a split pair, the switch forwarded it already
+            if ip_pkt:
+                self.add_microflow(datapath, pkt, ip_pkt)
+            return
+
         if pkt.get_protocol(ipv6.ipv6):  # Drop the IPV6 Packets.
             match = parser.OFPMatch(eth_type=eth.ethertype)
             actions = []
             self.add_flow(datapath, 1, match, actions)
             return None
 
+        self.forward_packet(msg, pkt)
+
+    def forward_packet(self, msg, pkt, defer=True):
+        '''
+        Learn from the packet, install the paths it needs and send it on.
+        If the paths are left to the path workers, the packet is forwarded
+        again once they are known
+        '''
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        in_port = msg.match['in_port']
+        eth = pkt.get_protocol(ethernet.ethernet)
+        arp_pkt = pkt.get_protocol(arp.arp)
+        ip_pkt = pkt.get_protocol(ipv4.ipv4)
+
+        def deferred(h1, h2):
+            return defer and self.defer_paths(
+                [(h1[0], h2[0]), (h2[0], h1[0])],
+                lambda: self.forward_packet(msg, pkt, defer=False))
+
         dst = eth.dst
         src = eth.src
         dpid = datapath.id
 
         if src not in self.hosts:
             self.hosts[src] = (dpid, in_port)
+            self.add_qos_ingress(datapath, in_port)
 
         out_port = ofproto.OFPP_FLOOD
 
@@ -290,24 +3057,49 @@ class ProjectController(app_manager.RyuApp):
             # print dpid, pkt
             src_ip = arp_pkt.src_ip
             dst_ip = arp_pkt.dst_ip
+            # learn every sender, so proactive mode knows all hosts
+            self.arp_table[src_ip] = src
             if arp_pkt.opcode == arp.ARP_REPLY:
-                self.arp_table[src_ip] = src
                 h1 = self.hosts[src]
                 h2 = self.hosts[dst]
+                if deferred(h1, h2):
+                    return
                 out_port = self.install_paths(h1[0], h1[1], h2[0], h2[1], src_ip, dst_ip)
                 self.install_paths(h2[0], h2[1], h1[0], h1[1], dst_ip, src_ip) # reverse
             elif arp_pkt.opcode == arp.ARP_REQUEST:
                 if dst_ip in self.arp_table:
-                    self.arp_table[src_ip] = src
                     dst_mac = self.arp_table[dst_ip]
                     h1 = self.hosts[src]
                     h2 = self.hosts[dst_mac]
+                    if deferred(h1, h2):
+                        return
                     out_port = self.install_paths(h1[0], h1[1], h2[0], h2[1], src_ip, dst_ip)
                     self.install_paths(h2[0], h2[1], h1[0], h1[1], dst_ip, src_ip) # reverse
+                    if ARP_PROXY and src_ip != dst_ip:
+                        self.send_arp_reply(h1, src, src_ip, dst_mac, dst_ip)
+                        return
+        elif ip_pkt and dst in self.hosts and self.hosts[src][0] == dpid:
+            # the flows of a known pair expired, install the path again
+            h1 = self.hosts[src]
+            h2 = self.hosts[dst]
+            if deferred(h1, h2):
+                return
+            out_port = self.install_paths(h1[0], h1[1], h2[0], h2[1], ip_pkt.src, ip_pkt.dst)
 
         # print pkt
 
-        actions = [parser.OFPActionOutput(out_port)]
+        if out_port is None:
+            # no path available
+            out_port = ofproto.OFPP_FLOOD
+
+        if (out_port == ofproto.OFPP_FLOOD and FLOOD_MODE == 'tree'
+                and dpid in self.switch_ports):
+            actions = [parser.OFPActionOutput(port)
+                       for port in self.get_flood_ports(dpid, in_port)]
+            if not actions:
+                return
+        else:
+            actions = [parser.OFPActionOutput(out_port)]
 
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
@@ -318,6 +3110,29 @@ class ProjectController(app_manager.RyuApp):
             actions=actions, data=data)
         datapath.send_msg(out)
 
+    def send_arp_reply(self, host, host_mac, host_ip, target_mac, target_ip):
+        '''
+        Answer the ARP request of a host for target_ip directly on the
+        switch port the host is connected to
+        '''
+        datapath = self.datapath_list[host[0]]
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            ethertype=ether_types.ETH_TYPE_ARP, dst=host_mac, src=target_mac))
+        pkt.add_protocol(arp.arp(
+            opcode=arp.ARP_REPLY, src_mac=target_mac, src_ip=target_ip,
+            dst_mac=host_mac, dst_ip=host_ip))
+        pkt.serialize()
+
+        actions = [parser.OFPActionOutput(host[1])]
+        out = parser.OFPPacketOut(
+            datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+            in_port=ofproto.OFPP_CONTROLLER, actions=actions, data=pkt.data)
+        datapath.send_msg(out)
+
     @set_ev_cls(event.EventSwitchEnter)
     def switch_enter_handler(self, ev):
         switch = ev.switch.dp
@@ -326,6 +3141,9 @@ class ProjectController(app_manager.RyuApp):
         if switch.id not in self.switches:
             self.switches.append(switch.id)
             self.datapath_list[switch.id] = switch
+            self.restore_links(switch.id)
+            self.topology_changed(entered=switch.id)
+            self.start_resync(switch)
 
             # Request port/link descriptions, useful for obtaining bandwidth
             req = ofp_parser.OFPPortDescStatsRequest(switch)
@@ -339,6 +3157,52 @@ class ProjectController(app_manager.RyuApp):
             self.switches.remove(switch)
             del self.datapath_list[switch]
             del self.adjacency[switch]
+            self.port_utilization.pop(switch, None)
+            self.flows.pop(switch, None)
+            self.shadow_flows.pop(switch, None)
+            self.qos_rules.pop(switch, None)
+            for key in [k for k in self.shadow_groups if k[0] == switch]:
+                del self.shadow_groups[key]
+            self.flood_rules.pop(switch, None)
+            self.flood_sets.pop(switch, None)
+            self.switch_ports.pop(switch, None)
+            self.group_allocators.pop(switch, None)
+            for key in [k for k in self.group_refs if k[0] == switch]:
+                del self.group_refs[key]
+            for key in [k for k in self.multipath_group_ids if k[0] == switch]:
+                del self.multipath_group_ids[key]
+            for key in [k for k in self.select_groups if k[0] == switch]:
+                self.forget_select_group(*key)
+            for key in [k for k in self.split_pairs if k[0] == switch]:
+                del self.split_pairs[key]
+            for key in [k for k in self.restored_links if switch in k]:
+                del self.restored_links[key]
+            for key in [k for k in self.link_delays if switch in k]:
+                del self.link_delays[key]
+                self.cost_delays.pop(key, None)
+            self.echo_rtts.pop(switch, None)
+            self.resyncs.pop(switch, None)
+            for key in [k for k in self.resync_xids if k[0] == switch]:
+                self.resync_xids.discard(key)
+            self.resynced.discard(switch)
+            for key in [k for k in self.elephants if k[0] == switch]:
+                del self.elephants[key]
+            for key in [k for k in self.port_tx_bytes if k[0] == switch]:
+                del self.port_tx_bytes[key]
+                self.cost_residuals.pop(key, None)
+            for neighbor in self.adjacency:
+                self.adjacency[neighbor].pop(switch, None)
+            self.path_cache.invalidate_switch(switch)
+            self.topology_changed()
+            # the switch will never confirm its outstanding barriers
+            for (dpid, xid), install_id in list(self.barrier_xids.items()):
+                if dpid == switch:
+                    del self.barrier_xids[dpid, xid]
+                    self._barrier_done(dpid, install_id)
+            self.reroute_installs(
+                [key for key, install in self.installs.items()
+                 if switch in install['switches']],
+                f"leave of switch {switch}")
 
     @set_ev_cls(event.EventLinkAdd, MAIN_DISPATCHER)
     def link_add_handler(self, ev):
@@ -346,14 +3210,65 @@ class ProjectController(app_manager.RyuApp):
         s2 = ev.link.dst
         self.adjacency[s1.dpid][s2.dpid] = s1.port_no
         self.adjacency[s2.dpid][s1.dpid] = s2.port_no
+        self.restored_links.pop((s1.dpid, s2.dpid), None)
+        self.restored_links.pop((s2.dpid, s1.dpid), None)
+        # a new link may offer cheaper paths for any pair
+        self.path_cache.bump_version()
+        self.topology_changed(added=[(s1.dpid, s2.dpid)])
 
     @set_ev_cls(event.EventLinkDelete, MAIN_DISPATCHER)
     def link_delete_handler(self, ev):
         s1 = ev.link.src
         s2 = ev.link.dst
-        # Exception handling if switch already deleted
+        self.remove_links([(s1.dpid, s1.port_no, s2.dpid, s2.port_no)],
+                          f"failure of link {s1.dpid} <-> {s2.dpid}")
+
+    def remove_links(self, links, reason):
+        '''
+        Remove links given as (dpid1, port1, dpid2, port2) and reroute the
+        pairs crossing any of them at once
+        '''
+        affected = set()
+        for dpid1, port1, dpid2, port2 in links:
+            # Exception handling if switch already deleted
+            try:
+                del self.adjacency[dpid1][dpid2]
+                del self.adjacency[dpid2][dpid1]
+            except KeyError:
+                pass
+            self.restored_links.pop((dpid1, dpid2), None)
+            self.restored_links.pop((dpid2, dpid1), None)
+            for key in ((dpid1, dpid2), (dpid2, dpid1)):
+                self.link_delays.pop(key, None)
+                self.cost_delays.pop(key, None)
+            self.path_cache.invalidate_link(dpid1, dpid2)
+            affected |= self.link_installs.get((dpid1, port1), set())
+            affected |= self.link_installs.get((dpid2, port2), set())
+        self.topology_changed(removed=[(dpid1, dpid2) for dpid1, _, dpid2, _ in links])
+        self.reroute_installs(affected, reason)
+
+
+class MultipathRestController(ControllerBase):
+
+    def __init__(self, req, link, data, **config):
+        super(MultipathRestController, self).__init__(req, link, data, **config)
+        self.multipath_app = data[multipath_instance_name]
+
+    @route('multipath', PREINSTALL_URL, methods=['POST'])
+    def preinstall_paths(self, req, **kwargs):
         try:
-            del self.adjacency[s1.dpid][s2.dpid]
-            del self.adjacency[s2.dpid][s1.dpid]
-        except KeyError:
-            pass
+            body = req.json if req.body else {}
+            pairs = [dict(pair, ip_src=pair['ip_src'], ip_dst=pair['ip_dst'])
+                     for pair in body.get('pairs', [])]
+            hosts = [dict(ip=host['ip'], mac=host['mac'], dpid=int(host['dpid']),
+                          port=int(host['port'])) for host in body.get('hosts', [])]
+            timeout = float(body.get('timeout', PREINSTALL_TIMEOUT))
+        except (ValueError, AttributeError, KeyError, TypeError):
+            return Response(status=400)
+        result = self.multipath_app.preinstall_paths(pairs, hosts, timeout)
+        return Response(content_type='application/json', text=json.dumps(result))
+
+    @route('multipath', METRICS_URL, methods=['GET'])
+    def get_metrics(self, req, **kwargs):
+        return Response(content_type='text/plain', charset='utf-8',
+                        text=self.multipath_app.get_metrics())
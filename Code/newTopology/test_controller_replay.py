@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+from ryu.app.wsgi import WSGIApplication
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3, ofproto_parser
+from ryu.topology import event
+from ryu.topology.switches import Switch, Link, Port
+import contextlib
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import ryu_multipath
+import controller_replay
+from controller_benchmark import FakeDatapath, PortDesc, acknowledge_barriers
+
+'''
+Records a live run of the controller with fake switches into an event log and replays it.
+
+python3 -m unittest test_controller_replay.py
+'''
+
+def multipart_reply(dp, stats_type, xid):
+    # an empty multipart reply as the switch would send it
+    buf = struct.pack('!BBHI', ofproto_v1_3.OFP_VERSION, ofproto_v1_3.OFPT_MULTIPART_REPLY, 16, xid)
+    buf += struct.pack('!HH4x', stats_type, 0)
+    return ofp_event.ofp_msg_to_ev(ofproto_parser.msg(dp, *ofproto_parser.header(buf), buf))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        ryu_multipath.SNAPSHOT_FILE = None
+        ryu_multipath.PATH_WORKERS = 0
+        handle, self.log = tempfile.mkstemp(suffix='.evlog')
+        os.close(handle)
+        os.remove(self.log)
+
+    def tearDown(self):
+        ryu_multipath.EVENT_LOG_FILE = None
+        if os.path.exists(self.log):
+            os.remove(self.log)
+
+    def record(self):
+        ryu_multipath.EVENT_LOG_FILE = self.log
+        app = ryu_multipath.ProjectController(wsgi=WSGIApplication())
+        ryu_multipath.EVENT_LOG_FILE = None
+        handlers = controller_replay.get_handlers(app)
+
+        def dispatch(ev):
+            for handler in handlers[type(ev)]:
+                handler(ev)
+            acknowledge_barriers(app, datapaths)
+
+        # the live switches number their requests differently than the replay
+        datapaths = {}
+        for dpid in range(1, 5):
+            datapaths[dpid] = FakeDatapath(dpid)
+            datapaths[dpid].xid = 1000 * dpid
+        for dp in datapaths.values():
+            dispatch(event.EventSwitchEnter(Switch(dp)))
+        for s1, port1, s2, port2 in ((1, 1, 2, 1), (2, 2, 4, 1), (4, 2, 3, 1), (3, 2, 1, 2)):
+            for a, pa, b, pb in ((s1, port1, s2, port2), (s2, port2, s1, port1)):
+                dispatch(event.EventLinkAdd(Link(Port(a, ofproto_v1_3, PortDesc(pa)),
+                                                 Port(b, ofproto_v1_3, PortDesc(pb)))))
+        for dpid, dp in datapaths.items():
+            dispatch(multipart_reply(dp, ofproto_v1_3.OFPMP_GROUP_DESC, 1))
+            dispatch(multipart_reply(dp, ofproto_v1_3.OFPMP_FLOW, app.resyncs[dpid]['xid']))
+        app.close()
+        return app
+
+    def test_replay_completes_resync(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            live = self.record()
+            result = controller_replay.replay(self.log, 0)
+        self.assertEqual(len(live.resynced), 4)
+        self.assertEqual(result['resynced'], len(live.resynced))
+        self.assertEqual(sum(stats['errors'] for stats in result['per_event'].values()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()